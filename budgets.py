@@ -0,0 +1,307 @@
+# budgets.py
+import os
+import json
+import math
+import time
+import atexit
+import threading
+from contextlib import contextmanager
+
+import requests
+
+from plan_cache import CACHE_DIR
+
+STATS_PATH = os.path.join(CACHE_DIR, "stage_stats.json")
+
+# stage -> (max_tokens, timeout) used until enough samples exist; -1 / None = unbounded
+STAGE_DEFAULTS = {
+    "detect_mode": (8, 10),
+    "questions": (300, 15),
+    "refine_summary": (160, 15),
+    "phases": (-1, None),
+    "phase_adapt": (-1, None),
+    "microtask": (-1, 300),
+    "chat": (-1, None),
+    "chat_summary": (200, 60),
+}
+
+MIN_SAMPLES = 20          # samples per stage before the learned budget replaces the default
+WINDOW = 200              # recent samples kept per stage
+PERCENTILE = 0.95
+TOKEN_MARGIN = 1.5        # budget = p95 * margin + slack
+TOKEN_SLACK = 32
+TIME_MARGIN = 2.0
+TIME_SLACK = 5.0
+WIDEN_HIT_RATE = 0.05     # more recent hits than this -> the budget is cutting off normal output, double it
+MAX_WIDEN = 16
+NARROW_AFTER = 4 * MIN_SAMPLES  # this many runs in a row without a hit halve the widening again
+OUTLIER_MADS = 6.0        # samples beyond median + 6 * MAD are flagged
+
+
+def _percentile(values, q):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def _outlier_limit(values):
+    if len(values) < MIN_SAMPLES:
+        return None
+    median = _percentile(values, 0.5)
+    mad = _percentile([abs(v - median) for v in values], 0.5)
+    return median + OUTLIER_MADS * max(mad, 0.05 * median, 1e-9)
+
+
+class StageRun:
+    """
+    One generation of a stage: carries its budget and collects what it used.
+    Feed it response chunks (or the final JSON) with observe(); stream
+    readers should stop when expired() turns true.
+    """
+
+    def __init__(self, stage, max_tokens, timeout):
+        self.stage = stage
+        self.max_tokens = max_tokens
+        self.timeout = timeout
+        self.started = time.monotonic()
+        self.chunks = 0
+        self.completion_tokens = None
+        self.finish_reason = None
+        self.timed_out = False
+        self.discarded = False
+        self.queue_timeout = None      # max wait for a server slot (set under a deadline)
+        self.deadline_limited = False  # budget was tightened to fit a deadline
+
+    def start(self):
+        """Restart the clock (call once the request actually has a server slot)."""
+        self.started = time.monotonic()
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    def observe(self, msg: dict):
+        usage = msg.get("usage") or {}
+        if usage.get("completion_tokens") is not None:
+            self.completion_tokens = usage["completion_tokens"]
+        timings = msg.get("timings") or {}
+        if timings.get("predicted_n") is not None and self.completion_tokens is None:
+            self.completion_tokens = timings["predicted_n"]
+        for choice in msg.get("choices") or []:
+            if not isinstance(choice, dict):
+                continue
+            if choice.get("finish_reason"):
+                self.finish_reason = choice["finish_reason"]
+            if (choice.get("delta") or {}).get("content"):
+                # streaming servers send about one token per chunk
+                self.chunks += 1
+
+    def observe_response(self, response):
+        """Non-streamed call: latency from the response itself (so queue wait is excluded), usage from its JSON."""
+        self.started = time.monotonic() - response.elapsed.total_seconds()
+        try:
+            self.observe(response.json())
+        except ValueError:
+            pass
+
+    def expired(self):
+        if self.timeout is not None and self.elapsed > self.timeout:
+            self.timed_out = True
+        return self.timed_out
+
+    def discard(self):
+        """Don't record this run (cancelled / speculative work that was thrown away)."""
+        self.discarded = True
+
+    @property
+    def tokens(self):
+        return self.completion_tokens if self.completion_tokens is not None else self.chunks
+
+    @property
+    def hit_limit(self):
+        return self.finish_reason == "length"
+
+
+class StageBudgets:
+    """
+    Persistent per-stage statistics of completion tokens and latency.
+
+    budget(stage) returns (max_tokens, timeout): the stage defaults until
+    MIN_SAMPLES generations were seen, then p95 * margin + slack of the recent
+    window. A stage whose recent runs keep hitting the budget gets it doubled,
+    so normal output is not cut off, and halved again after NARROW_AFTER runs
+    without a hit; samples far above the median are counted as outliers.
+    report() shows the numbers per stage.
+    """
+
+    def __init__(self, path: str = STATS_PATH, defaults: dict = None):
+        self.path = path
+        self.defaults = dict(STAGE_DEFAULTS if defaults is None else defaults)
+        self._lock = threading.Lock()
+        self._dirty = 0
+        self.stages = self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.load(f).get("stages", {})
+        except (OSError, ValueError):
+            return {}
+
+    def save(self):
+        with self._lock:
+            data = json.dumps({"stages": self.stages})
+            self._dirty = 0
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = self.path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(data)
+            os.replace(tmp, self.path)
+        except OSError:
+            pass
+
+    def _stage(self, stage):
+        return self.stages.setdefault(stage, {
+            "samples": [],      # [tokens, seconds, hit]
+            "count": 0,
+            "hits": 0,
+            "timeouts": 0,
+            "outliers": 0,
+            "widen": 1,
+            "calm": 0,          # runs since the last hit
+        })
+
+    def rate(self, stage):
+        """Median completion tokens per second of stage, or None without enough samples."""
+        with self._lock:
+            st = self.stages.get(stage)
+            rates = [s[0] / s[1] for s in st["samples"] if s[1] > 0] if st else []
+        return _percentile(rates, 0.5) if len(rates) >= MIN_SAMPLES else None
+
+    def budget(self, stage):
+        """(max_tokens, timeout) for the next generation of stage."""
+        default_tokens, default_timeout = self.defaults.get(stage, (-1, None))
+        with self._lock:
+            st = self.stages.get(stage)
+            samples = list(st["samples"]) if st else []
+            widen = st["widen"] if st else 1
+        if len(samples) < MIN_SAMPLES:
+            return default_tokens, default_timeout
+        tokens = _percentile([s[0] for s in samples], PERCENTILE)
+        seconds = _percentile([s[1] for s in samples], PERCENTILE)
+        max_tokens = int(math.ceil(tokens * TOKEN_MARGIN * widen)) + TOKEN_SLACK
+        timeout = round(seconds * TIME_MARGIN * widen + TIME_SLACK, 1)
+        return max_tokens, timeout
+
+    def record(self, run: StageRun):
+        """Add a finished run. Returns True if it was flagged as an outlier."""
+        hit = run.hit_limit or run.timed_out
+        with self._lock:
+            st = self._stage(run.stage)
+            token_limit = _outlier_limit([s[0] for s in st["samples"]])
+            time_limit = _outlier_limit([s[1] for s in st["samples"]])
+            outlier = bool((token_limit is not None and run.tokens > token_limit)
+                           or (time_limit is not None and run.elapsed > time_limit))
+
+            st["samples"].append([run.tokens, round(run.elapsed, 3), hit])
+            del st["samples"][:-WINDOW]
+            st["count"] += 1
+            st["hits"] += int(run.hit_limit)
+            st["timeouts"] += int(run.timed_out)
+            st["outliers"] += int(outlier)
+
+            # censored samples (cut off by the budget) under-report the real length
+            recent = st["samples"][-MIN_SAMPLES:]
+            if len(recent) >= MIN_SAMPLES and sum(1 for s in recent if s[2]) / len(recent) > WIDEN_HIT_RATE:
+                st["widen"] = min(st["widen"] * 2, MAX_WIDEN)
+                st["calm"] = 0
+                for s in recent:
+                    s[2] = False   # count the next window fresh
+            elif hit:
+                st["calm"] = 0
+            else:
+                # a burst of hits must not loosen the budget for good
+                st["calm"] = st.get("calm", 0) + 1
+                if st["widen"] > 1 and st["calm"] >= NARROW_AFTER:
+                    st["widen"] //= 2
+                    st["calm"] = 0
+            self._dirty += 1
+            save = self._dirty >= 10
+        if save:
+            self.save()
+        return outlier
+
+    @contextmanager
+    def track(self, stage, max_tokens=None, timeout=None, deadline=None):
+        """
+        Context manager yielding a StageRun with the stage's budget; explicit
+        max_tokens / timeout override it. Under a deadline.Deadline the
+        timeout, the slot wait and (from the stage's token rate) max_tokens
+        are cut to the time left.
+        The run is recorded on exit unless discarded; a requests timeout
+        counts as a timed-out run, and so does a ConnectionError once the
+        timeout has passed (a stall mid-stream: iter_content wraps the read
+        timeout in ConnectionError). Runs cut short by the deadline aren't
+        recorded as budget hits, so they don't widen the budget.
+        """
+        budget_tokens, budget_timeout = self.budget(stage)
+        run = StageRun(stage,
+                       budget_tokens if max_tokens is None else max_tokens,
+                       budget_timeout if timeout is None else timeout)
+        if deadline is not None:
+            left = deadline.remaining()
+            run.queue_timeout = left
+            if run.timeout is None or left < run.timeout:
+                run.timeout = left
+                run.deadline_limited = True
+            rate = self.rate(stage)
+            if rate:
+                cap = max(16, int(rate * left * 0.8))
+                if run.max_tokens is None or run.max_tokens < 0 or cap < run.max_tokens:
+                    run.max_tokens = cap
+                    run.deadline_limited = True
+        try:
+            yield run
+        except requests.exceptions.RequestException as e:
+            if isinstance(e, requests.exceptions.Timeout) or (
+                    isinstance(e, requests.exceptions.ConnectionError)
+                    and run.timeout is not None and run.elapsed >= run.timeout):
+                run.timed_out = True
+                if not run.deadline_limited:
+                    self.record(run)
+            raise
+        else:
+            if run.discarded or (run.deadline_limited and (run.timed_out or run.hit_limit)):
+                return
+            self.record(run)
+
+    def report(self):
+        """Per stage: count, p50/p95 tokens and seconds, budget, hit/timeout rates, outliers."""
+        with self._lock:
+            stages = {name: dict(st, samples=list(st["samples"])) for name, st in self.stages.items()}
+        out = {}
+        for name, st in sorted(stages.items()):
+            tokens = [s[0] for s in st["samples"]]
+            seconds = [s[1] for s in st["samples"]]
+            max_tokens, timeout = self.budget(name)
+            count = st["count"] or 1
+            out[name] = {
+                "count": st["count"],
+                "tokens_p50": _percentile(tokens, 0.5),
+                "tokens_p95": _percentile(tokens, PERCENTILE),
+                "seconds_p50": _percentile(seconds, 0.5),
+                "seconds_p95": _percentile(seconds, PERCENTILE),
+                "max_tokens": max_tokens,
+                "timeout": timeout,
+                "hit_rate": st["hits"] / count,
+                "timeout_rate": st["timeouts"] / count,
+                "outliers": st["outliers"],
+            }
+        return out
+
+
+# Shared budgets used by every module
+BUDGETS = StageBudgets()
+atexit.register(BUDGETS.save)
@@ -0,0 +1,149 @@
+# chat_history.py
+import threading
+
+from prompts import CHAT_SUMMARY_PROMPT
+from scheduler import SCHEDULER, BACKGROUND
+from budgets import BUDGETS
+
+API_URL = "http://localhost:8000/v1/chat/completions"
+
+
+class Conversation:
+    """
+    Multi-turn chat memory for chat mode.
+
+    - keeps the last `max_turns` turns verbatim; older turns are folded into a
+      running summary, `summarize_batch` turns at a time, so the prompt prefix
+      stays byte-identical for several turns in a row
+    - pins the conversation to one server slot (`id_slot` + `cache_prompt`),
+      so each new turn only needs prompt processing for the newly added tokens;
+      the slot is reserved through SCHEDULER so no other request evicts it.
+      When no slot can be reserved the conversation runs unpinned (slot None).
+      close() gives the slot back.
+    - records prompt-eval counts per turn (see `stats`)
+    """
+
+    def __init__(self, max_turns: int = 8, summarize_batch: int = 4, pin: bool = True,
+                 system_prompt: str = "You are a helpful assistant."):
+        self.max_turns = max_turns
+        self.summarize_batch = max(1, summarize_batch)
+        self.slot = SCHEDULER.reserve_slot(API_URL) if pin else None
+        self.system_prompt = system_prompt
+        self.summary = ""
+        self.turns = []          # list of (user, assistant)
+        self.stats = []          # one dict per completed turn
+        self._pending_usage = {}
+        self._summarizer = None
+        self._lock = threading.Lock()
+
+    # ---- prompt construction -------------------------------------------
+
+    def build_messages(self, user_message: str):
+        """Messages for the next turn: system (+summary), recent turns, new user message."""
+        self.wait_for_summary()
+        system = self.system_prompt
+        if self.summary:
+            system += "\n\nSummary of the earlier conversation:\n" + self.summary
+        messages = [{"role": "system", "content": system}]
+        with self._lock:
+            for user, assistant in self.turns:
+                messages.append({"role": "user", "content": user})
+                messages.append({"role": "assistant", "content": assistant})
+        messages.append({"role": "user", "content": user_message})
+        return messages
+
+    def payload_fields(self):
+        """Extra request fields for the conversation's KV-cache slot (send with slot=self.slot)."""
+        return {
+            "cache_prompt": True,
+            "stream_options": {"include_usage": True},
+        }
+
+    def close(self):
+        """Give the reserved server slot back to the scheduler."""
+        slot, self.slot = self.slot, None
+        SCHEDULER.release_slot(API_URL, slot)
+
+    # ---- bookkeeping ----------------------------------------------------
+
+    def record_usage(self, msg: dict):
+        """Collect usage/timings from a response chunk (OpenAI usage or llama.cpp timings)."""
+        usage = msg.get("usage") or {}
+        timings = msg.get("timings") or {}
+        if usage:
+            self._pending_usage["prompt_tokens"] = usage.get("prompt_tokens")
+            self._pending_usage["completion_tokens"] = usage.get("completion_tokens")
+            details = usage.get("prompt_tokens_details") or {}
+            if details.get("cached_tokens") is not None:
+                self._pending_usage["cached_tokens"] = details["cached_tokens"]
+        if timings:
+            # prompt_n is what the server actually evaluated; cache_n was reused from the slot
+            self._pending_usage["prompt_eval"] = timings.get("prompt_n")
+            if timings.get("cache_n") is not None:
+                self._pending_usage["cached_tokens"] = timings["cache_n"]
+
+    def add_turn(self, user_message: str, assistant_message: str):
+        usage, self._pending_usage = self._pending_usage, {}
+        prompt_eval = usage.get("prompt_eval")
+        if prompt_eval is None and usage.get("prompt_tokens") is not None:
+            prompt_eval = usage["prompt_tokens"] - (usage.get("cached_tokens") or 0)
+        with self._lock:
+            self.turns.append((user_message, assistant_message))
+            self.stats.append({
+                "turn": len(self.stats) + 1,
+                "prompt_tokens": usage.get("prompt_tokens"),
+                "cached_tokens": usage.get("cached_tokens"),
+                "prompt_eval": prompt_eval,
+                "completion_tokens": usage.get("completion_tokens"),
+            })
+        self._maybe_summarize()
+
+    def reset(self):
+        self.wait_for_summary()
+        with self._lock:
+            self.summary = ""
+            self.turns = []
+            self.stats = []
+
+    # ---- summarisation --------------------------------------------------
+
+    def _maybe_summarize(self):
+        if len(self.turns) <= self.max_turns or self._summarizer is not None:
+            return
+        with self._lock:
+            old = self.turns[:self.summarize_batch]
+        # runs while the user reads/types; build_messages waits for it
+        self._summarizer = threading.Thread(target=self._summarize, args=(old,), daemon=True)
+        self._summarizer.start()
+
+    def _summarize(self, old_turns):
+        transcript = "\n".join(f"User: {u}\nAssistant: {a}" for u, a in old_turns)
+        content = CHAT_SUMMARY_PROMPT + f"Existing summary: {self.summary or 'None'}\n\nNew turns:\n{transcript}"
+        summary = None
+        try:
+            with BUDGETS.track("chat_summary") as run:
+                payload = {
+                    "model": "local-model",
+                    "stream": False,
+                    "temperature": 0.0,
+                    "max_tokens": run.max_tokens,
+                    "messages": [{"role": "user", "content": content}],
+                }
+                r = SCHEDULER.post(API_URL, payload, priority=BACKGROUND, timeout=run.timeout)
+                r.raise_for_status()
+                run.observe_response(r)
+            summary = r.json()["choices"][0]["message"]["content"].strip()
+        except Exception:
+            pass
+        with self._lock:
+            if summary:
+                self.summary = summary
+            else:
+                # keep the prompt bounded even if the model call failed
+                self.summary = (self.summary + "\n" + transcript)[-1500:].strip()
+            del self.turns[:len(old_turns)]
+
+    def wait_for_summary(self):
+        if self._summarizer is not None:
+            self._summarizer.join()
+            self._summarizer = None
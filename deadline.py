@@ -0,0 +1,54 @@
+# deadline.py
+import time
+from contextlib import contextmanager
+
+# Below this many seconds left a stage skips its model call and uses its fallback
+MIN_STAGE_SECONDS = 2.0
+
+
+class Deadline:
+    """
+    Overall time budget of one phase-mode request, created at the entry point
+    and passed down the pipeline. Stages take their timeout and token budget
+    from remaining() and degrade (fallback question, shorter microtasks,
+    partial plan, skipped commands) as it runs out.
+    Time spent waiting for the user doesn't count, see paused().
+    """
+
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    @classmethod
+    def after(cls, seconds):
+        """Deadline `seconds` from now, or None when seconds is None/0 (no deadline)."""
+        return cls(seconds) if seconds else None
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+    @property
+    def expired(self):
+        return self.remaining() <= 0
+
+    def allows(self, seconds: float = MIN_STAGE_SECONDS):
+        """True if at least `seconds` are left, i.e. a stage is worth starting."""
+        return self.remaining() >= seconds
+
+    def clamp(self, timeout):
+        """timeout limited to the time left (None means no limit of its own)."""
+        left = self.remaining()
+        return left if timeout is None else min(timeout, left)
+
+    def share(self, parts: int):
+        """A deadline for one of `parts` equal shares of the time left."""
+        return Deadline(self.remaining() / max(1, parts))
+
+    @contextmanager
+    def paused(self):
+        """Don't count the time spent inside the block (e.g. input())."""
+        start = time.monotonic()
+        try:
+            yield self
+        finally:
+            self.expires_at += time.monotonic() - start
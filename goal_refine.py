@@ -1,23 +1,28 @@
 # goal_refine.py
-import requests
 import json
 import re
 import ast
-from prompts import GOAL_QUESTIONS_PROMPT, GOAL_SUMMARIZE_PROMPT
+import time
+from prompts import GOAL_QUESTIONS_PROMPT, GOAL_SUMMARIZE_PROMPT, KNOWN_ANSWERS_PROMPT
+from scheduler import SCHEDULER, INTERACTIVE
+from budgets import BUDGETS
 
 API_URL = "http://localhost:8000/v1/chat/completions"
 
-def _call_completion(messages, temperature=0.0, max_tokens=200, timeout=15):
-    headers = {"Content-Type": "application/json"}
-    payload = {
-        "model": "local-model",
-        "stream": False,
-        "temperature": temperature,
-        "max_tokens": max_tokens,
-        "messages": messages
-    }
-    r = requests.post(API_URL, json=payload, headers=headers, timeout=timeout)
-    r.raise_for_status()
+def _call_completion(messages, temperature=0.0, max_tokens=None, timeout=None, priority=INTERACTIVE, stage="questions",
+                     deadline=None):
+    # max_tokens / timeout default to the learned budget of stage, cut to the deadline if there is one
+    with BUDGETS.track(stage, max_tokens=max_tokens, timeout=timeout, deadline=deadline) as run:
+        payload = {
+            "model": "local-model",
+            "stream": False,
+            "temperature": temperature,
+            "max_tokens": run.max_tokens,
+            "messages": messages
+        }
+        r = SCHEDULER.post(API_URL, payload, priority=priority, timeout=run.timeout, queue_timeout=run.queue_timeout)
+        r.raise_for_status()
+        run.observe_response(r)
     data = r.json()
     # try chat-style content
     if "choices" in data and len(data["choices"]) > 0:
@@ -34,6 +39,59 @@ def _call_completion(messages, temperature=0.0, max_tokens=200, timeout=15):
     # fallback: raw response to string
     return json.dumps(data)
 
+def _stream_completion(messages, temperature=0.0, max_tokens=None, timeout=None, priority=INTERACTIVE, scope=None,
+                       stage="questions"):
+    """
+    Streamed variant of _call_completion, so the request can be cancelled
+    mid-generation through `scope`. Returns "" if it was cancelled.
+    """
+    text = ""
+    with BUDGETS.track(stage, max_tokens=max_tokens, timeout=timeout) as run:
+        payload = {
+            "model": "local-model",
+            "stream": True,
+            "temperature": temperature,
+            "max_tokens": run.max_tokens,
+            "messages": messages
+        }
+        with SCHEDULER.stream(API_URL, payload, priority=priority, timeout=run.timeout, scope=scope) as ticket:
+            run.start()
+            ticket.response.raise_for_status()
+            for raw in ticket.iter_lines():
+                if not raw or not raw.startswith(b"data: "):
+                    continue
+                data = raw[len(b"data: "):]
+                if data == b"[DONE]" or run.expired():
+                    break
+                try:
+                    msg = json.loads(data.decode())
+                    run.observe(msg)
+                    text += msg["choices"][0]["delta"].get("content", "") or ""
+                except Exception:
+                    continue
+            if ticket.cancelled.is_set():
+                run.discard()
+                return ""
+    return text.strip()
+
+def request_clarifying_questions(raw_goal: str, priority=INTERACTIVE, scope=None, deadline=None, known=None):
+    """
+    Ask the model for the clarifying-questions JSON for raw_goal.
+    Returns the raw model text ("" on failure). With a scope the call is
+    streamed, so speculative requests can be cancelled.
+    `known` is a list of {"question", "answer"} the model is told not to ask again.
+    """
+    content = GOAL_QUESTIONS_PROMPT + raw_goal
+    if known:
+        content += KNOWN_ANSWERS_PROMPT + "\n".join(f"- {k['question']} -> {k['answer']}" for k in known)
+    messages = [{"role": "user", "content": content}]
+    try:
+        if scope is None:
+            return _call_completion(messages, temperature=0.0, priority=priority, deadline=deadline)
+        return _stream_completion(messages, temperature=0.0, priority=priority, scope=scope)
+    except Exception:
+        return ""
+
 def _extract_json_array(text):
     """
     Find the first JSON array ( [...] ) in text and parse it.
@@ -54,28 +112,86 @@ def _extract_json_array(text):
         except Exception:
             return None
 
-def refine_goal_interactive(raw_goal: str):
+def ask_in_terminal(q):
+    """
+    Default answer source: print the question (choices as A/B/C) and read the answer with input().
+    q is a dict with "question", "type" and "choices", and optionally a "default"
+    (the previous answer) that is used when the input is left empty.
+    """
+    default = q.get("default")
+    hint = f" [{default}]" if default else ""
+    if q["type"] == "choice" and q["choices"]:
+        # present choices numerically and alphabetically as A/B/C
+        print("\n" + q["question"])
+        for i, choice in enumerate(q["choices"], start=1):
+            letter = chr(ord('A') + i - 1)
+            print(f"  {letter}) {choice}")
+        ans = input(f"Your choice (letter or text){hint}: ").strip()
+        if not ans and default:
+            return default
+        # normalize letter -> choice text
+        if len(ans) == 1 and ans.upper() >= 'A' and (ord(ans.upper()) - 65) < len(q["choices"]):
+            idx = ord(ans.upper()) - 65
+            return q["choices"][idx]
+        return ans
+    # free text
+    ans = input("\n" + q["question"] + f"\nYour answer{hint}: ").strip()
+    if not ans and default:
+        return default
+    return ans
+
+def _question_key(text: str):
+    return re.sub(r"\W+", " ", (text or "").lower()).strip()
+
+def _fallback_summary(raw_goal: str, qa_list: list):
+    answers = "; ".join(str(qa["answer"]) for qa in qa_list if qa["answer"])
+    return f"{raw_goal.strip()} ({answers})" if answers else raw_goal.strip()
+
+def refine_goal_interactive(raw_goal: str, ask=None, q_text=None, questions=None, previous_answers=None, deadline=None,
+                            preferences=None, known=None):
     """
     1) Ask model to produce JSON array of clarifying questions for raw_goal.
     2) Loop through array, prompt user to answer each question.
     3) Send original goal + collected Q&A to model to produce one concise paragraph.
     4) Print and return the final paragraph.
+    `ask` is called with each question dict and returns the answer (default: ask_in_terminal).
+    `q_text` is an already fetched questions response (e.g. started speculatively); it skips step 1.
+    `known` are the known answers q_text was requested with (see request_clarifying_questions).
+    `questions` is an already normalized question list (e.g. from the previous plan when replanning); it skips step 1 too.
+    `previous_answers` is a Q&A list from an earlier run; matching questions get it as "default".
+    With a `deadline` (deadline.Deadline) the model calls are fitted to the time left; when
+    too little is left the fallback question is asked and the answers are joined onto the
+    goal instead of being summarized. Time spent answering doesn't count.
+    `preferences` (preferences.PreferenceStore) remembers answers across runs: known answers
+    of similar past goals are passed to the question generator (and on to the summary),
+    remembered answers become defaults or, once
+    settled, answer the question without asking; for a familiar goal whose questions are
+    all settled the question request is skipped.
     """
-    # Step 1: request questions
-    q_prompt = GOAL_QUESTIONS_PROMPT + raw_goal
-    try:
-        q_text = _call_completion(
-            messages=[{"role":"user","content": q_prompt}],
-            temperature=0.0,
-            max_tokens=300
-        )
-    except Exception as e:
-        q_text = ""
+    ask = ask or ask_in_terminal
+    # when replanning (previous_answers) every question is asked again, remembered answers only prefill
+    auto_answer = preferences is not None and previous_answers is None
+    # known answers the question generator was actually told about
+    told = (known or []) if q_text else []
 
-    questions = _extract_json_array(q_text)
+    # Step 1: request questions
+    if not questions and not q_text and auto_answer:
+        questions = preferences.questions_for(raw_goal)
+        if questions:
+            preferences.metrics["question_requests_skipped"] += 1
+    if not questions:
+        if q_text and preferences is not None:
+            preferences.metrics["question_requests"] += 1  # made speculatively by the caller
+        elif not q_text and (deadline is None or deadline.allows()):
+            told = preferences.known_answers(raw_goal) if auto_answer else []
+            q_text = request_clarifying_questions(raw_goal, deadline=deadline, known=told)
+            if preferences is not None:
+                preferences.metrics["question_requests"] += 1
+        questions = _extract_json_array(q_text)
 
     # If model didn't return JSON array, create a fallback: single open text question
-    if not isinstance(questions, list) or len(questions) == 0:
+    # (an empty array is fine when the known answers already cover everything)
+    if not isinstance(questions, list) or (len(questions) == 0 and not told):
         questions = [
             {"id": 1, "question": "Please describe what specific kind of project you want (1–2 short words).", "type": "text", "choices": []}
         ]
@@ -104,40 +220,68 @@ def refine_goal_interactive(raw_goal: str):
                 "choices": []
             })
 
+    defaults = {_question_key(qa["question"]): qa["answer"] for qa in previous_answers or []}
+
     # Step 2: loop and get answers from user
     qa_list = []
+    auto_answered = 0
     for q in norm_questions:
-        if q["type"] == "choice" and q["choices"]:
-            # present choices numerically and alphabetically as A/B/C
-            print("\n" + q["question"])
-            for i, choice in enumerate(q["choices"], start=1):
-                letter = chr(ord('A') + i - 1)
-                print(f"  {letter}) {choice}")
-            ans = input("Your choice (letter or text): ").strip()
-            # normalize letter -> choice text
-            if len(ans) == 1 and ans.upper() >= 'A' and (ord(ans.upper()) - 65) < len(q["choices"]):
-                idx = ord(ans.upper()) - 65
-                answer = q["choices"][idx]
-            else:
-                answer = ans
+        if defaults.get(_question_key(q["question"])):
+            q = dict(q, default=defaults[_question_key(q["question"])])
+        elif preferences is not None:
+            remembered, confident = preferences.suggest(q)
+            if confident and auto_answer:
+                print(f"\n{q['question']}\nRemembered answer: {remembered}")
+                qa_list.append({"question": q["question"], "answer": remembered})
+                auto_answered += 1
+                continue
+            if remembered:
+                q = dict(q, default=remembered)
+                preferences.metrics["prefilled"] += 1
+
+        start = time.monotonic()
+        if deadline is not None:
+            with deadline.paused():
+                answer = ask(q)
         else:
-            # free text
-            answer = input("\n" + q["question"] + "\nYour answer: ").strip()
+            answer = ask(q)
         qa_list.append({"question": q["question"], "answer": answer})
 
+        if preferences is not None:
+            preferences.metrics["asked"] += 1
+            preferences.metrics["answer_seconds"] += time.monotonic() - start
+            if q.get("default") and answer == q["default"]:
+                preferences.metrics["prefill_accepted"] += 1
+            preferences.record(q, answer)
+
+    # answers the generator was told not to ask about still belong in the refined goal
+    asked_keys = {_question_key(qa["question"]) for qa in qa_list}
+    for k in told:
+        if _question_key(k["question"]) not in asked_keys:
+            qa_list.append({"question": k["question"], "answer": k["answer"]})
+
+    if preferences is not None:
+        preferences.metrics["goals"] += 1
+        preferences.metrics["auto_answered"] += auto_answered
+        preferences.record_goal(raw_goal, norm_questions)
+
     # Step 3: summarize into one concise paragraph
     # Build a compact input for summarizer
     qa_json = json.dumps(qa_list, ensure_ascii=False)
     summarize_input = f"Original Goal: {raw_goal}\nClarifying Q&A: {qa_json}"
 
-    try:
-        summary = _call_completion(
-            messages=[{"role":"user","content": GOAL_SUMMARIZE_PROMPT + "\n" + summarize_input}],
-            temperature=0.15,
-            max_tokens=160
-        )
-    except Exception:
-        summary = raw_goal.strip()
+    if deadline is not None and not deadline.allows():
+        summary = _fallback_summary(raw_goal, qa_list)
+    else:
+        try:
+            summary = _call_completion(
+                messages=[{"role":"user","content": GOAL_SUMMARIZE_PROMPT + "\n" + summarize_input}],
+                temperature=0.15,
+                stage="refine_summary",
+                deadline=deadline
+            )
+        except Exception:
+            summary = raw_goal.strip() if deadline is None else _fallback_summary(raw_goal, qa_list)
 
     # Take only first paragraph / line(s)
     # Remove excessive whitespace
@@ -149,5 +293,7 @@ def refine_goal_interactive(raw_goal: str):
     return {
         "refined_goal_paragraph": final,
         "qa": qa_list,
-        "original_goal": raw_goal
+        "original_goal": raw_goal,
+        "questions": norm_questions,
+        "auto_answered": auto_answered
     }
@@ -0,0 +1,178 @@
+# install_batch.py
+import os
+import re
+import shlex
+
+WHEELHOUSE = os.path.join(os.path.expanduser("~"), ".e_zero", "wheelhouse")
+
+# flags that can be shared by a merged install (commands only merge with identical flags)
+PIP_FLAGS = {"-q", "--quiet", "-U", "--upgrade", "--user", "--pre", "--no-cache-dir"}
+NPM_FLAGS = {"-D", "--save-dev", "-g", "--global", "-E", "--save-exact", "--silent", "--no-fund", "--no-audit"}
+
+# a plain requirement: name, optional extras, optional version spec (no paths, URLs or archives)
+REQUIREMENT_REGEX = re.compile(r"^[A-Za-z0-9][A-Za-z0-9._-]*(\[[A-Za-z0-9,._-]+\])?((~=|==|!=|<=|>=|<|>|===)[^\s/]+)?$")
+PINNED_REGEX = re.compile(r"^([A-Za-z0-9][A-Za-z0-9._-]*)(\[[A-Za-z0-9,._-]+\])?==([A-Za-z0-9.!+_-]+)$")
+NPM_PACKAGE_REGEX = re.compile(r"^(@[a-z0-9._-]+/)?[a-z0-9._-]+(@[^\s/]+)?$", flags=re.IGNORECASE)
+
+# commands after which earlier installs no longer target the same environment
+ENV_CHANGE_REGEX = re.compile(
+    r"^\s*(cd\s|pushd\s|popd\b|source\s|\.\s|deactivate\b|conda\s+(activate|create)|nvm\s+use|"
+    r"(python[0-9.]*|py)\s+-m\s+venv\b|virtualenv\b|npm\s+init\b|yarn\s+init\b|pnpm\s+init\b)"
+)
+MANAGER_REGEX = re.compile(r"\b(pip[0-9.]*|npm|yarn|pnpm)\b")
+
+
+def _package_name(spec: str, manager: str):
+    if manager == "pip":
+        return re.split(r"[\[<>=!~]", spec, 1)[0].lower().replace("_", "-")
+    # npm: keep the scope, drop the version
+    return spec[:spec.index("@", 1)] if "@" in spec[1:] else spec
+
+
+def _canonical(name: str):
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+def _wheelhouse_has(packages: list):
+    """
+    True if every package is pinned (name==version) and a wheel of that version
+    is already in WHEELHOUSE (built there by an earlier `pip wheel`, together
+    with its dependencies). Unpinned packages always need a resolve.
+    """
+    try:
+        files = os.listdir(WHEELHOUSE)
+    except OSError:
+        return False
+    # wheel file names: {name}-{version}(-{build})?-{python}-{abi}-{platform}.whl
+    have = {(_canonical(parts[0]), parts[1]) for parts in (f[:-4].split("-") for f in files if f.endswith(".whl"))
+            if len(parts) >= 5}
+    for spec in packages:
+        m = PINNED_REGEX.match(spec)
+        if m is None or (_canonical(m.group(1)), m.group(3)) not in have:
+            return False
+    return True
+
+
+def parse_install(cmd: str):
+    """
+    Recognise a mergeable package-manager install. Returns
+    {"manager", "prefix", "flags", "packages"} or None when the command is
+    not an install of plain package names (e.g. `pip install -r req.txt`, `npm install`).
+    """
+    try:
+        tokens = shlex.split(cmd)
+    except ValueError:
+        return None
+    if not tokens:
+        return None
+
+    # pip / pip3 / venv/bin/pip install ...  |  python -m pip install ...
+    exe = os.path.basename(tokens[0])
+    if re.fullmatch(r"pip[0-9.]*", exe) and tokens[1:2] == ["install"]:
+        manager, prefix, args = "pip", tokens[:2], tokens[2:]
+    elif re.fullmatch(r"python[0-9.]*", exe) and tokens[1:4] == ["-m", "pip", "install"]:
+        manager, prefix, args = "pip", tokens[:4], tokens[4:]
+    elif exe == "npm" and tokens[1:2] and tokens[1] in ("install", "i", "add"):
+        manager, prefix, args = "npm", ["npm", "install"], tokens[2:]
+    elif exe in ("yarn", "pnpm") and tokens[1:2] == ["add"]:
+        manager, prefix, args = exe, tokens[:2], tokens[2:]
+    else:
+        return None
+
+    allowed = PIP_FLAGS if manager == "pip" else NPM_FLAGS
+    valid = REQUIREMENT_REGEX if manager == "pip" else NPM_PACKAGE_REGEX
+    flags, packages = [], []
+    for a in args:
+        if a.startswith("-"):
+            if a not in allowed:
+                return None
+            flags.append(a)
+        elif valid.match(a):
+            packages.append(a)
+        else:
+            return None
+    if not packages:
+        return None
+    return {"manager": manager, "prefix": prefix, "flags": tuple(sorted(set(flags))), "packages": packages}
+
+
+def _render(group, use_cache: bool):
+    prefix, flags, packages = group["prefix"], list(group["flags"]), list(group["packages"].values())
+    if group["manager"] == "pip":
+        if not use_cache:
+            return [shlex.join(prefix + flags + packages)]
+        # resolve + build wheels once into the local wheelhouse, then install from it;
+        # `pip wheel` (not `pip download`) so sdists are built while the index is still
+        # available, the wheelhouse holds only wheels and the install works offline.
+        # Pinned requirements already in the wheelhouse skip the index altogether.
+        install = prefix + flags + ["--no-index", "--find-links", WHEELHOUSE] + packages
+        if _wheelhouse_has(packages):
+            return [shlex.join(install)]
+        build = prefix[:-1] + ["wheel", "--wheel-dir", WHEELHOUSE] + [f for f in flags if f == "--pre"] + packages
+        return [shlex.join(build), shlex.join(install)]
+    if use_cache:
+        flags.append("--prefer-offline")
+    return [shlex.join(prefix + flags + packages)]
+
+
+def batch_install_commands(commands: list, use_cache: bool = True):
+    """
+    Merge package installs for the same environment into one invocation.
+
+    `commands` is a list of (phase_index, command). Installs with the same
+    installer and flags are merged into the first of them, which is the
+    earliest valid point, so a later command never loses a package it relied on.
+    Merging stops at anything that may change what the install targets:
+    cd / venv creation or activation / npm init, any other command of the
+    same package manager (pip install -r ..., npm install, pip uninstall,
+    an install with other flags such as pip install --upgrade pip),
+    or a conflicting version spec for the same package.
+    Returns a new list of (phase_index, command).
+    """
+    open_groups = {}   # (prefix, flags) -> group
+    items = []         # (phase_index, command str | group)
+
+    for phase_idx, cmd in commands:
+        cmd = cmd.strip()
+        if ENV_CHANGE_REGEX.match(cmd):
+            open_groups.clear()
+            items.append((phase_idx, cmd))
+            continue
+
+        inst = parse_install(cmd)
+        if inst is None:
+            m = MANAGER_REGEX.search(cmd)
+            if m:
+                manager = "pip" if m.group(1).startswith("pip") else m.group(1)
+                for key in [k for k, g in open_groups.items() if g["manager"] == manager]:
+                    del open_groups[key]
+            items.append((phase_idx, cmd))
+            continue
+
+        key = (tuple(inst["prefix"]), inst["flags"])
+        group = open_groups.get(key)
+        if group is not None:
+            for spec in inst["packages"]:
+                existing = group["packages"].get(_package_name(spec, inst["manager"]))
+                if existing is not None and existing != spec:
+                    # same package, different version: keep the original order
+                    del open_groups[key]
+                    group = None
+                    break
+        if group is None:
+            # an install that isn't merged runs in place, after every open group of its manager
+            for other in [k for k, g in open_groups.items() if g["manager"] == inst["manager"]]:
+                del open_groups[other]
+            group = {"manager": inst["manager"], "prefix": inst["prefix"], "flags": inst["flags"], "packages": {}}
+            open_groups[key] = group
+            items.append((phase_idx, group))
+        for spec in inst["packages"]:
+            group["packages"].setdefault(_package_name(spec, inst["manager"]), spec)
+
+    out = []
+    for phase_idx, item in items:
+        if isinstance(item, dict):
+            out.extend((phase_idx, c) for c in _render(item, use_cache))
+        else:
+            out.append((phase_idx, item))
+    return out
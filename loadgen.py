@@ -0,0 +1,140 @@
+# loadgen.py
+"""
+Load generator for server.py: simulates N concurrent users, each opening a
+session, sending a message and answering clarifying questions automatically.
+
+Typical setup:
+  python mock_model_server.py --slots 2
+  python server.py
+  python loadgen.py --users 1,2,4,8,16 --rounds 2
+
+For each user count it reports throughput, time to first token, turn latency
+and the server's scheduler queue-wait, so you can see where scaling stops.
+"""
+import json
+import time
+import random
+import argparse
+import threading
+
+import requests
+
+MESSAGES = [
+    "create a flask app locally",
+    "set up a python project with a venv",
+    "build a static personal website",
+    "a todo list web app with flask",
+    "what is a python generator?",
+    "explain the difference between a list and a tuple?",
+]
+
+
+def _percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct))]
+
+
+def _events(resp):
+    """Parse an SSE response into (event, data) pairs."""
+    event = None
+    buffer = b""
+    while True:
+        # read1() returns as soon as any bytes arrive; iter_lines() would wait for a full chunk
+        chunk = resp.raw.read1(65536)
+        if not chunk:
+            return
+        buffer += chunk
+        while b"\n" in buffer:
+            raw, buffer = buffer.split(b"\n", 1)
+            line = raw.decode("utf-8").rstrip("\r")
+            if not line or line.startswith(":"):
+                continue
+            if line.startswith("event: "):
+                event = line[len("event: "):]
+            elif line.startswith("data: "):
+                yield event, json.loads(line[len("data: "):])
+
+
+def simulate_user(base_url, message, think_time, results):
+    http = requests.Session()
+    t0 = time.monotonic()
+    first_token = None
+    questions = 0
+    try:
+        sid = http.post(f"{base_url}/sessions", timeout=30).json()["session_id"]
+        events = http.get(f"{base_url}/sessions/{sid}/events", stream=True, timeout=600)
+        http.post(f"{base_url}/sessions/{sid}/messages", json={"message": message}, timeout=30)
+        for event, data in _events(events):
+            if event == "token" and first_token is None:
+                first_token = time.monotonic() - t0
+            elif event == "question":
+                questions += 1
+                if think_time:
+                    time.sleep(think_time)
+                answer = data["choices"][0] if data.get("choices") else "yes"
+                http.post(f"{base_url}/sessions/{sid}/answer", json={"question_id": data["question_id"], "answer": answer}, timeout=30)
+            elif event in ("done", "error"):
+                results.append({
+                    "ok": event == "done",
+                    "latency": time.monotonic() - t0,
+                    "ttft": first_token,
+                    "questions": questions,
+                    "mode": data.get("mode"),
+                })
+                break
+        events.close()
+        http.delete(f"{base_url}/sessions/{sid}", timeout=30)
+    except Exception as e:
+        results.append({"ok": False, "latency": time.monotonic() - t0, "ttft": None, "error": str(e)})
+
+
+def run_step(base_url, users, rounds, think_time):
+    results = []
+    start = time.monotonic()
+    for _ in range(rounds):
+        threads = [
+            threading.Thread(target=simulate_user, args=(base_url, random.choice(MESSAGES), think_time, results))
+            for _ in range(users)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    wall = time.monotonic() - start
+
+    ok = [r for r in results if r["ok"]]
+    latencies = [r["latency"] for r in ok]
+    ttfts = [r["ttft"] for r in ok if r["ttft"] is not None]
+    try:
+        stats = requests.get(f"{base_url}/stats", timeout=10).json()
+    except Exception:
+        stats = {}
+    return {
+        "users": users,
+        "turns": len(results),
+        "errors": len(results) - len(ok),
+        "throughput": len(ok) / wall if wall else 0.0,
+        "latency_p50": _percentile(latencies, 0.5),
+        "latency_p95": _percentile(latencies, 0.95),
+        "ttft_p50": _percentile(ttfts, 0.5),
+        "ttft_p95": _percentile(ttfts, 0.95),
+        "queue_wait": stats.get("queue_wait", {}),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulate concurrent users against server.py.")
+    parser.add_argument("--url", default="http://127.0.0.1:8080")
+    parser.add_argument("--users", default="1,2,4,8", help="comma-separated concurrent user counts to step through")
+    parser.add_argument("--rounds", type=int, default=1, help="turns per user at each step")
+    parser.add_argument("--think-time", type=float, default=0.0, help="seconds a user takes to answer a question")
+    args = parser.parse_args()
+
+    print(f"{'users':>5} {'turns':>5} {'err':>4} {'turns/s':>8} {'p50 s':>7} {'p95 s':>7} {'ttft50':>7} {'ttft95':>7}  interactive wait p95")
+    for n in [int(x) for x in args.users.split(",") if x.strip()]:
+        r = run_step(args.url, n, args.rounds, args.think_time)
+        wait = r["queue_wait"].get("interactive", {}).get("p95", 0.0)
+        print(f"{r['users']:>5} {r['turns']:>5} {r['errors']:>4} {r['throughput']:>8.2f} "
+              f"{r['latency_p50']:>7.2f} {r['latency_p95']:>7.2f} {r['ttft_p50']:>7.2f} {r['ttft_p95']:>7.2f}  {wait:.3f}s")
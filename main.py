@@ -1,14 +1,40 @@
-import requests
+import os
 import json
 import re
+import queue
+import requests
+import concurrent.futures
 from phase_init import Phase
-from mode_detector import detect_mode
-from goal_refine import refine_goal_interactive
-from micro_tasks import generate_microtasks_for_phases
-from run_commands import execute_microtask_output
+from mode_detector import detect_mode, PHRASE_REGEX
+from goal_refine import refine_goal_interactive, ask_in_terminal, request_clarifying_questions
+from plan_state import Plan, build_plan, plan_summary
+from run_commands import execute_plan
+from snapshot import WorkspaceSnapshots
+from deadline import Deadline
+from plan_cache import PlanIndex
+from preferences import PreferenceStore
+from chat_history import Conversation
+from budgets import BUDGETS
+from scheduler import SCHEDULER, INTERACTIVE, SPECULATIVE, CancelScope, Cancelled, set_session, current_session
 
 API_URL = "http://localhost:8000/v1/chat/completions"
 
+PLAN_INDEX = PlanIndex()
+PREFERENCES = PreferenceStore()
+
+# Optional overall time budget (seconds) of a phase-mode request; 0 = none.
+# Change it in the REPL with "deadline <seconds>" / "deadline off".
+DEADLINE_SECONDS = float(os.environ.get("E_ZERO_DEADLINE", "0") or 0)
+
+# Per-stage speculation while detect_mode runs (see Speculation).
+# min_free_slots None derives the idle slots a stage needs from the scheduler's
+# slots; set a number to demand more headroom (or disable the stage).
+SPECULATION = {
+    "questions": {"enabled": True, "min_free_slots": None},
+    "chat": {"enabled": True, "min_free_slots": None},
+}
+_SPECULATION_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=8)
+
 # ANSI Colors
 YELLOW = "\033[33m"
 GREEN = "\033[32m"
@@ -36,54 +62,299 @@ def colorize(text, in_block):
     return text, in_block
 
 
-def stream_chat(prompt):
-    headers = {"Content-Type": "application/json"}
-    payload = {
-        "model": "local-model",
-        "stream": True,
-        "temperature": 0.7,
-        "max_tokens": -1,
-        "messages": [
-            {"role": "user", "content": prompt}
-        ]
-    }
+def iter_chat_tokens(prompt, priority=INTERACTIVE, scope=None, conversation=None):
+    """
+    Yield content tokens of a streamed chat completion for prompt.
+    With a Conversation, earlier turns are sent too (pinned to the
+    conversation's server slot) and the completed turn is recorded.
+    The learned chat timeout only bounds a stall between chunks, so a long
+    answer that keeps streaming isn't cut. A stream error (e.g. a stall) is
+    raised to the caller after the tokens that arrived; that turn isn't recorded.
+    """
+    messages = [{"role": "user", "content": prompt}]
+    if conversation is not None:
+        messages = conversation.build_messages(prompt)
+
+    full_text = ""
+    with BUDGETS.track("chat") as run:
+        payload = {
+            "model": "local-model",
+            "stream": True,
+            "temperature": 0.7,
+            "max_tokens": run.max_tokens,
+            "messages": messages
+        }
+        if conversation is not None:
+            payload.update(conversation.payload_fields())
+
+        slot = conversation.slot if conversation is not None else None
+        with SCHEDULER.stream(API_URL, payload, priority=priority, scope=scope, timeout=run.timeout,
+                              slot=slot) as ticket:
+            run.start()
+            for raw in ticket.iter_lines():
+                if not raw:
+                    continue
+                if not raw.startswith(b"data: "):
+                    continue
+
+                data = raw[len(b"data: "):]
+                if data == b"[DONE]":
+                    break
+
+                try:
+                    msg = json.loads(data.decode())
+                    run.observe(msg)
+                    if conversation is not None:
+                        conversation.record_usage(msg)
+                    token = msg["choices"][0]["delta"].get("content", "")
+                except:
+                    continue
+                if token:
+                    full_text += token
+                    yield token
+
+            cancelled = ticket.cancelled.is_set()
+            if cancelled:
+                run.discard()
+
+    if conversation is not None and not cancelled and full_text:
+        conversation.add_turn(prompt, full_text)
+
 
+def render_tokens(tokens):
+    """Print a token stream line by line with code/inline highlighting. Returns the full text."""
     print(f"\n{YELLOW}--- Streaming Response ---{RESET}\n")
 
     in_code_block = False
     buffer = ""
+    full_text = ""
 
-    with requests.post(API_URL, json=payload, headers=headers, stream=True) as r:
-        for raw in r.iter_lines():
-            if not raw:
-                continue
-            if not raw.startswith(b"data: "):
-                continue
+    for token in tokens:
+        full_text += token
+        buffer += token
 
-            data = raw[len(b"data: "):]
-            if data == b"[DONE]":
-                break
+        # Print only when we see complete newlines:
+        while "\n" in buffer:
+            line, buffer = buffer.split("\n", 1)
+            colored, in_code_block = colorize(line, in_code_block)
+            print(colored + "\n", end="", flush=True)
 
-            try:
-                msg = json.loads(data.decode())
-                token = msg["choices"][0]["delta"].get("content", "")
-                if not token:
-                    continue
+    print(f"\n{YELLOW}--- End of Response ---{RESET}\n")
+    return full_text
 
-                buffer += token
 
-                # Print only when we see complete newlines:
-                while "\n" in buffer:
-                    line, buffer = buffer.split("\n", 1)
-                    colored, in_code_block = colorize(line, in_code_block)
-                    print(colored + "\n", end="", flush=True)
+def stream_chat(prompt, on_token=None, conversation=None):
+    """
+    Stream a chat answer. Prints colorized lines, or passes raw tokens to
+    on_token when given. Returns the full response text.
+    """
+    tokens = iter_chat_tokens(prompt, conversation=conversation)
+    if on_token is None:
+        return render_tokens(tokens)
 
-            except:
-                continue
+    full_text = ""
+    for token in tokens:
+        full_text += token
+        on_token(token)
+    return full_text
 
-    print(f"\n{YELLOW}--- End of Response ---{RESET}\n")
+
+def _min_free(stage, derived):
+    """Idle shared slots a speculative stage needs: SPECULATION's min_free_slots or the derived count."""
+    configured = SPECULATION[stage].get("min_free_slots")
+    return derived if configured is None else max(configured, derived)
+
+
+class Speculation:
+    """
+    Start the work for both possible modes while detect_mode is still running:
+    the clarifying-questions request (phase mode) and the chat answer
+    (normal mode). resolve(mode) cancels the loser and promotes the winner,
+    saving roughly one model round-trip either way.
+
+    Each stage only speculates if enabled in SPECULATION and it gets a slot
+    of its own: detect_mode keeps one of the scheduler's shared slots, the
+    question request needs another one, and so does the chat answer unless
+    its conversation has a reserved slot that is idle. With the default two
+    slots and a pinned conversation, detect_mode and the chat answer run side
+    by side; the question request needs a third slot.
+    """
+
+    def __init__(self, message, conversation=None, preferences=None):
+        self.message = message
+        self.conversation = conversation
+        self.preferences = preferences
+        self.question_scope = self.chat_scope = None
+        self.known = None   # known answers sent with the speculative question request
+        self.question_future = self.chat_future = None
+        self.chat_tokens = queue.Queue()
+
+        session = current_session()
+        free = SCHEDULER.free_slots(API_URL)
+        needed = 1    # detect_mode's slot
+        # a familiar goal whose questions are all answered from preferences needs no question request
+        familiar = preferences is not None and preferences.questions_for(message) is not None
+        if SPECULATION["questions"]["enabled"] and not familiar and free >= _min_free("questions", needed + 1):
+            needed += 1
+            self.question_scope = CancelScope()
+            self.question_future = _SPECULATION_POOL.submit(self._fetch_questions, session)
+        slot = conversation.slot if conversation is not None else None
+        if slot is None:
+            needed += 1
+        elif not SCHEDULER.slot_idle(API_URL, slot):
+            needed = None
+        if SPECULATION["chat"]["enabled"] and needed is not None and free >= _min_free("chat", needed):
+            self.chat_scope = CancelScope()
+            self.chat_future = _SPECULATION_POOL.submit(self._collect_chat, session)
+
+    def _fetch_questions(self, session):
+        set_session(session)
+        if self.preferences is not None:
+            self.known = self.preferences.known_answers(self.message)
+        return request_clarifying_questions(self.message, SPECULATIVE, self.question_scope, known=self.known)
+
+    def _collect_chat(self, session):
+        set_session(session)
+        try:
+            for token in iter_chat_tokens(self.message, SPECULATIVE, self.chat_scope, self.conversation):
+                self.chat_tokens.put(token)
+        except Exception as e:
+            # not consumed yet: chat() returns None and the caller asks again;
+            # already being consumed: the consumer gets the error
+            self.chat_scope.cancel()
+            self.chat_tokens.put(e)
+        finally:
+            self.chat_tokens.put(None)
+
+    def resolve(self, mode):
+        winner, loser = (self.question_scope, self.chat_scope) if mode == "phase" else (self.chat_scope, self.question_scope)
+        if loser is not None:
+            loser.cancel()
+        if winner is not None:
+            SCHEDULER.promote(winner, INTERACTIVE)
+
+    def questions(self):
+        """Speculatively fetched questions text, or None if not available (caller fetches normally)."""
+        if self.question_future is None:
+            return None
+        text = self.question_future.result()
+        return None if self.question_scope.cancelled or not text else text
+
+    def chat(self):
+        """
+        Token iterator of the speculative chat answer, or None if it was not
+        started or got cut short. A stream error is raised by the iterator.
+        """
+        if self.chat_future is None or self.chat_scope.cancelled:
+            return None
+        return self._chat_tokens()
+
+    def _chat_tokens(self):
+        for item in iter(self.chat_tokens.get, None):
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+
+def plan_phases(refined_goal, ask=None, deadline=None):
+    """
+    Reuse phases from a similar past goal when the user accepts them
+    (optionally with a light model edit); otherwise plan from scratch.
+    Fallback or cut-off phase lists (see phase_init.PhaseList) aren't indexed.
+    """
+    ask = ask or ask_in_terminal
+    match = PLAN_INDEX.lookup(refined_goal)
+    phases = None
+
+    if match and deadline is not None and not deadline.allows():
+        # no time left to plan: a similar past plan beats the generic fallback
+        entry, _ = match
+        phases = list(entry["phases"])
+    elif match:
+        entry, similarity = match
+        question = {
+            "question": f"Found a similar past goal ({similarity:.0%} match): {entry['goal']}\n"
+                        f"Phases: {entry['phases']}\nReuse these phases?",
+            "type": "choice",
+            "choices": ["yes", "edit for this goal", "no"],
+        }
+        if deadline is not None:
+            with deadline.paused():
+                choice = ask(question)
+        else:
+            choice = ask(question)
+        choice = choice.strip().lower()
+        if choice.startswith("y"):
+            phases = list(entry["phases"])
+        elif choice.startswith("e"):
+            phases = Phase.adapt(refined_goal, entry["phases"], deadline=deadline)
+
+    if phases is None:
+        phases = Phase.init(refined_goal, deadline=deadline)
+
+    if getattr(phases, "complete", True):
+        PLAN_INDEX.add(refined_goal, phases)
+    return phases
+
+
+def replan(old_plan, new_goal=None, ask=None, on_token=None, deadline=None, preferences=None):
+    """
+    Re-run phase mode for an edited goal (or re-answered questions) starting
+    from old_plan: the previous questions are asked again with the old
+    answers as defaults, the old phase list is adapted rather than replaced,
+    and only microtasks whose inputs changed are regenerated.
+    Same raw goal and same answers: the old refined goal and phases are kept
+    (a new summary of the same inputs would only reword them).
+    """
+    goal = new_goal or old_plan.original_goal
+    result = refine_goal_interactive(goal, ask=ask,
+                                     questions=old_plan.questions, previous_answers=old_plan.qa,
+                                     deadline=deadline, preferences=preferences)
+    if goal == old_plan.original_goal and result.get("qa") == old_plan.qa:
+        result = dict(result, refined_goal_paragraph=old_plan.refined_goal)
+        refined_goal = old_plan.refined_goal
+        phases = old_plan.titles
+    else:
+        refined_goal = result["refined_goal_paragraph"]
+        phases = Phase.adapt(refined_goal, old_plan.titles, deadline=deadline)
+    if getattr(phases, "complete", True):
+        PLAN_INDEX.add(refined_goal, phases)
+    return build_plan(result, phases, old_plan=old_plan, on_token=on_token, deadline=deadline)
+
+
+def report_plan(plan, deadline=None):
+    """Print how the plan was built; a partial plan (deadline reached) lists the phases left out."""
+    kept, generated, skipped = plan_summary(plan)
+    print(f"[Plan: {kept} phase(s) kept, {generated} generated, {skipped} skipped]")
+    if skipped:
+        print(f"{YELLOW}⏱ Deadline of {deadline.seconds:g}s reached — partial plan. Not planned:{RESET}")
+        for p in plan.phases:
+            if p["status"] == "skipped":
+                print(f"  - {p['title']}")
+        print("Run \"replan\" (with more time) to plan the rest.")
+
+
+def confirm_run(deadline=None):
+    """Ask before running a plan's commands; the time spent answering isn't charged to the deadline."""
+    if deadline is not None:
+        with deadline.paused():
+            return confirm_run()
+    return input("Run these commands now? (y/N): ").strip().lower().startswith("y")
+
+
+def report_results(results, deadline=None):
+    """After execute_plan: say which commands the deadline cut off."""
+    skipped = [cmd for phase in results for cmd, status in phase if status == "skipped"]
+    if skipped:
+        print(f"{YELLOW}⏱ Deadline of {deadline.seconds:g}s reached — {len(skipped)} command(s) not run:{RESET}")
+        for cmd in skipped:
+            print(f"  - {cmd}")
 
 if __name__ == "__main__":
+    conversation = Conversation()
+    last_plan = Plan.load()
+    deadline_seconds = DEADLINE_SECONDS
+
     while True:
         user_message = input("You: ").strip()
 
@@ -91,24 +362,112 @@ if __name__ == "__main__":
             print("Goodbye!")
             break
 
+        if user_message.lower() == "stats":
+            for name, st in SCHEDULER.queue_wait_stats().items():
+                print(f"[queue wait] {name}: n={st['count']} mean={st['mean']:.3f}s p95={st['p95']:.3f}s max={st['max']:.3f}s")
+            print(f"[scheduler] preemptions: {SCHEDULER.preemptions}")
+            for stage, st in BUDGETS.report().items():
+                print(f"[budget] {stage}: n={st['count']} tokens p95={st['tokens_p95']} "
+                      f"max_tokens={st['max_tokens']} timeout={st['timeout']} "
+                      f"hit={st['hit_rate']:.1%} timed out={st['timeout_rate']:.1%} outliers={st['outliers']}")
+            prefs = PREFERENCES.report()
+            print(f"[preferences] goals={prefs['goals']} remembered={prefs['remembered']} "
+                  f"question requests/goal={prefs['question_requests_per_goal']:.2f} "
+                  f"asked/goal={prefs['asked_per_goal']:.2f} auto-answered/goal={prefs['auto_answered_per_goal']:.2f} "
+                  f"answer time/goal={prefs['answer_seconds_per_goal']:.1f}s")
+            for st in conversation.stats:
+                print(f"[chat turn {st['turn']}] prompt tokens: {st['prompt_tokens']} "
+                      f"cached: {st['cached_tokens']} evaluated: {st['prompt_eval']} completion: {st['completion_tokens']}")
+            continue
+
+        if user_message.lower() == "reset":
+            conversation.reset()
+            print("[Chat history cleared]")
+            continue
+
+        if user_message.lower() in ["prefs", "prefs clear"]:
+            if user_message.lower() == "prefs clear":
+                PREFERENCES.clear()
+                print("[Remembered answers cleared]")
+            for k in PREFERENCES.known_answers(limit=50):
+                print(f"- {k['question']} -> {k['answer']}")
+            continue
+
+        m = re.match(r"deadline\s+(off|\d+(?:\.\d+)?)$", user_message, flags=re.IGNORECASE)
+        if m:
+            deadline_seconds = 0 if m.group(1).lower() == "off" else float(m.group(1))
+            print(f"[Phase-mode deadline: {f'{deadline_seconds:g}s' if deadline_seconds else 'off'}]")
+            continue
+
+        # the request's overall time budget starts now (None when no deadline is set)
+        deadline = Deadline.after(deadline_seconds)
+
+        # --- Snapshots: undo or inspect what a phase's commands changed ---
+        m = re.match(r"(rollback|diff)\s+(\d+)$", user_message, flags=re.IGNORECASE)
+        if m:
+            snapshots = WorkspaceSnapshots()
+            try:
+                if m.group(1).lower() == "rollback":
+                    counts = snapshots.rollback(m.group(2))
+                    print(f"[Rolled back to before phase {m.group(2)}: "
+                          f"{counts['restored']} restored, {counts['deleted']} deleted]")
+                else:
+                    d = snapshots.diff(m.group(2))
+                    for rel in d["added"]:
+                        print(f"{GREEN}A {rel}{RESET}")
+                    for rel in d["removed"]:
+                        print(f"{MAGENTA}D {rel}{RESET}")
+                    for rel in d["modified"]:
+                        print(f"{YELLOW}M {rel}{RESET}")
+                    if d["patch"]:
+                        print("\n" + d["patch"])
+                    if not (d["added"] or d["removed"] or d["modified"]):
+                        print("[No changes]")
+            except KeyError:
+                print(f"[No snapshot for phase {m.group(2)}]")
+            except ValueError as e:
+                print(f"[{e}]")
+            continue
+
+        # --- Replan: edit the last phase-mode goal, regenerate only affected phases ---
+        if user_message.lower() == "replan" or user_message.lower().startswith("replan "):
+            if last_plan is None:
+                print("[No previous plan to replan]")
+                continue
+            plan = replan(last_plan, user_message[len("replan"):].strip() or None, deadline=deadline,
+                          preferences=PREFERENCES)
+            report_plan(plan, deadline)
+            plan.save()
+            last_plan = plan
+            if confirm_run(deadline):
+                report_results(execute_plan(plan.paragraphs, deadline=deadline), deadline)
+            continue
+
         # --- Auto detect mode ---
+        # When the regex can't decide, detect_mode makes a model call; overlap it with
+        # the first request of whichever mode wins.
+        speculation = None if PHRASE_REGEX.search(user_message) else Speculation(user_message, conversation, PREFERENCES)
         mode = detect_mode(user_message)
         print(f"[Mode detected: {mode}]")
+        if speculation:
+            speculation.resolve(mode)
 
         # --- Phase Mode ---
         if mode == "phase":
-            result = refine_goal_interactive(user_message)
+            q_text = speculation.questions() if speculation else None
+            result = refine_goal_interactive(user_message, q_text=q_text, deadline=deadline, preferences=PREFERENCES,
+                                             known=speculation.known if speculation else None)
             refined_goal = result["refined_goal_paragraph"]
 
-            phases = Phase.init(refined_goal)
-            micro_paragraphs = generate_microtasks_for_phases(refined_goal, phases)  # This streams & prints already
-            # print("Execution process ...")
-
-            # # run commands for each microtask paragraph (one by one)
-            # from run_commands import execute_microtask_output
+            phases = plan_phases(refined_goal, deadline=deadline)
+            plan = build_plan(result, phases, deadline=deadline)  # This streams & prints already
+            report_plan(plan, deadline)
+            plan.save()
+            last_plan = plan
 
-            # for para in micro_paragraphs:
-            #     execute_microtask_output(para)
+            # run the whole plan's commands (installs batched across phases) after confirmation
+            if confirm_run(deadline):
+                report_results(execute_plan(plan.paragraphs, deadline=deadline), deadline)
 
             # If Phase.init returns the list instead of printing, uncomment below:
             # for p in phases:
@@ -117,4 +476,11 @@ if __name__ == "__main__":
         # --- Normal Chat Mode (streaming) ---
         else:
             print("\nResponse:\n")
-            stream_chat(user_message)
\ No newline at end of file
+            tokens = speculation.chat() if speculation else None
+            try:
+                if tokens is not None:
+                    render_tokens(tokens)
+                else:
+                    stream_chat(user_message, conversation=conversation)
+            except (requests.exceptions.RequestException, Cancelled) as e:
+                print(f"\n❌ Stream error: {e}\n")
\ No newline at end of file
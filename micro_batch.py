@@ -0,0 +1,73 @@
+# micro_batch.py
+import time
+import queue
+import threading
+import concurrent.futures
+
+
+class MicroBatcher:
+    """
+    Collects small requests from many callers for up to `max_wait` seconds
+    (or until `max_batch` items are waiting) and hands them to
+    `handler(items) -> results` in one go. Each caller gets a Future that
+    resolves to its own result, so the extra latency per call is bounded by
+    max_wait plus the batch's own request time.
+
+    handler must return a list of the same length as items; an Exception
+    instance in that list fails just that caller's Future.
+    """
+
+    def __init__(self, handler, max_wait: float = 0.005, max_batch: int = 16, workers: int = 4):
+        self.handler = handler
+        self.max_wait = max_wait
+        self.max_batch = max(1, max_batch)
+        self._queue = queue.Queue()
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.batches = 0
+        self.items = 0
+        self._thread = threading.Thread(target=self._collect, daemon=True)
+        self._thread.start()
+
+    def submit(self, item):
+        future = concurrent.futures.Future()
+        self._queue.put((item, future))
+        return future
+
+    def __call__(self, item, timeout=None):
+        """Submit and wait for the result."""
+        return self.submit(item).result(timeout=timeout)
+
+    @property
+    def mean_batch_size(self):
+        return self.items / self.batches if self.batches else 0.0
+
+    def _collect(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self.batches += 1
+            self.items += len(batch)
+            # run the request off the collector thread so the next window starts immediately
+            self._pool.submit(self._run, batch)
+
+    def _run(self, batch):
+        items = [item for item, _ in batch]
+        try:
+            results = self.handler(items)
+            if len(results) != len(items):
+                raise ValueError(f"batch handler returned {len(results)} results for {len(items)} items")
+        except Exception as e:
+            results = [e] * len(items)
+        for (_, future), result in zip(batch, results):
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
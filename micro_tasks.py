@@ -3,6 +3,8 @@ import requests
 import json
 import re
 import time
+from scheduler import SCHEDULER, NORMAL, Cancelled
+from budgets import BUDGETS
 
 API_URL = "http://localhost:8000/v1/chat/completions"
 
@@ -138,7 +140,9 @@ def generate_micro_task_stream(
     previous_context: str = "",
     executed_commands: list = None,
     temperature: float = 0.25,
-    max_tokens: int = -1,
+    max_tokens: int = None,
+    on_token=None,
+    deadline=None,
 ):
     """
     Stream a micro-task paragraph for a single phase.
@@ -149,6 +153,9 @@ def generate_micro_task_stream(
     - Post-processes to remove duplicate commands/sentences and convert editor instructions
       to terminal-based suggestions.
     - Returns the final cleaned paragraph (with <cmd> tags where appropriate).
+    - If on_token is given, raw tokens are passed to it instead of printed.
+    - max_tokens and the time limit default to the learned "microtask" budget; a deadline
+      (deadline.Deadline) cuts both to the time left, which shortens the paragraph.
     """
     from prompts import MICRO_TASK_PROMPT
 
@@ -174,59 +181,72 @@ def generate_micro_task_stream(
         f"Now produce the next connected paragraph."
     )
 
-    headers = {"Content-Type": "application/json"}
-    payload = {
-        "model": "local-model",
-        "stream": True,
-        "temperature": temperature,
-        "max_tokens": max_tokens,
-        "messages": [{"role": "user", "content": user_prompt}],
-    }
-
-    print(f"\n{YELLOW}--- Micro Task: {phase} ---{RESET}\n")
+    if on_token is None:
+        print(f"\n{YELLOW}--- Micro Task: {phase} ---{RESET}\n")
 
     full_text = ""
     buffer = ""
     try:
-        with requests.post(API_URL, json=payload, headers=headers, stream=True, timeout=300) as resp:
-            for raw in resp.iter_lines():
-                if not raw:
-                    continue
-                if not raw.startswith(b"data: "):
-                    continue
-                data = raw[len(b"data: "):]
-                if data == b"[DONE]":
-                    break
-                try:
-                    msg = json.loads(data.decode("utf-8"))
-                except Exception:
-                    continue
-
-                token = ""
-                try:
-                    token = msg["choices"][0]["delta"].get("content", "")
-                except Exception:
-                    token = msg.get("content", "")
-
-                if not token:
-                    continue
-
-                buffer += token
-                full_text += token
-
-                # print complete lines to preserve coloring
-                while "\n" in buffer:
-                    line, buffer = buffer.split("\n", 1)
-                    rendered = _render_line_for_terminal(line)
-                    print(rendered + "\n", end="", flush=True)
-
-            # remaining buffer
-            if buffer.strip():
-                rendered = _render_line_for_terminal(buffer)
-                print(rendered, end="", flush=True)
+        with BUDGETS.track("microtask", max_tokens=max_tokens, deadline=deadline) as run:
+            payload = {
+                "model": "local-model",
+                "stream": True,
+                "temperature": temperature,
+                "max_tokens": run.max_tokens,
+                "messages": [{"role": "user", "content": user_prompt}],
+            }
+            with SCHEDULER.stream(API_URL, payload, priority=NORMAL, timeout=run.timeout,
+                                  queue_timeout=run.queue_timeout) as ticket:
+                run.start()
+                for raw in ticket.iter_lines():
+                    if not raw:
+                        continue
+                    if not raw.startswith(b"data: "):
+                        continue
+                    data = raw[len(b"data: "):]
+                    if data == b"[DONE]":
+                        break
+                    if run.expired():
+                        if on_token is None:
+                            print(f"\n{YELLOW}⏱ Stopped after {run.timeout}s (stage time budget){RESET}")
+                        break
+                    try:
+                        msg = json.loads(data.decode("utf-8"))
+                    except Exception:
+                        continue
+                    run.observe(msg)
+
+                    token = ""
+                    try:
+                        token = msg["choices"][0]["delta"].get("content", "")
+                    except Exception:
+                        token = msg.get("content", "")
+
+                    if not token:
+                        continue
+
+                    full_text += token
+                    if on_token is not None:
+                        on_token(token)
+                        continue
+                    buffer += token
+
+                    # print complete lines to preserve coloring
+                    while "\n" in buffer:
+                        line, buffer = buffer.split("\n", 1)
+                        rendered = _render_line_for_terminal(line)
+                        print(rendered + "\n", end="", flush=True)
+
+                # remaining buffer
+                if buffer.strip():
+                    rendered = _render_line_for_terminal(buffer)
+                    print(rendered, end="", flush=True)
 
     except requests.exceptions.RequestException as e:
         print(f"\n❌ Stream error: {e}\n")
+    except Cancelled:
+        if on_token is None:
+            print(f"\n{YELLOW}⏱ No server slot before the deadline{RESET}\n")
 
     paragraph = full_text.strip()
 
@@ -240,39 +260,60 @@ def generate_micro_task_stream(
         paragraph = "No action required."
 
     # separator for readability
-    print("\n")
+    if on_token is None:
+        print("\n")
 
     return paragraph
 
 
-def generate_microtasks_for_phases(goal: str, phases: list, delay_between: float = 0.12):
+def advance_context(previous_context: str, executed_commands: list, paragraph: str, max_chars: int = 1200):
+    """
+    Fold a finished phase paragraph into the running context.
+    Appends its new commands to executed_commands (in place) and returns
+    the updated previous_context, trimmed to its last max_chars.
+    """
+    # update executed_commands from this paragraph
+    new_cmds = _extract_cmds(paragraph)
+    for c in new_cmds:
+        nc = _normalize_cmd(c)
+        if nc and nc not in ( _normalize_cmd(x) for x in executed_commands ):
+            executed_commands.append(c.strip())
+
+    # update previous_context, keep tail to limit prompt size
+    if previous_context:
+        previous_context = (previous_context + "\n" + paragraph).strip()
+    else:
+        previous_context = paragraph.strip()
+
+    if len(previous_context) > max_chars:
+        previous_context = previous_context[-max_chars:]
+    return previous_context
+
+
+def generate_microtasks_for_phases(goal: str, phases: list, delay_between: float = 0.12, on_token=None, deadline=None):
     """
     Generate microtasks sequentially, passing previous context and executed commands.
     Returns list of paragraph strings (each may contain <cmd> tags).
+    If on_token is given it is called as on_token(phase, token) while streaming.
+    With a deadline each phase gets an equal share of the time left, and generation
+    stops early (returning the phases done so far) once too little is left.
     """
     results = []
     previous_context = ""
     executed_commands = []  # ordered unique list
 
-    for ph in phases:
-        paragraph = generate_micro_task_stream(goal, ph, previous_context, executed_commands)
+    for i, ph in enumerate(phases):
+        if deadline is not None and not deadline.allows():
+            if on_token is None:
+                print(f"\n{YELLOW}⏱ Deadline reached — {len(results)} of {len(phases)} phases planned{RESET}\n")
+            break
+        phase_on_token = None
+        if on_token is not None:
+            phase_on_token = lambda token, ph=ph: on_token(ph, token)
+        paragraph = generate_micro_task_stream(goal, ph, previous_context, executed_commands, on_token=phase_on_token,
+                                               deadline=deadline and deadline.share(len(phases) - i))
         results.append(paragraph)
-
-        # update executed_commands from this paragraph
-        new_cmds = _extract_cmds(paragraph)
-        for c in new_cmds:
-            nc = _normalize_cmd(c)
-            if nc and nc not in ( _normalize_cmd(x) for x in executed_commands ):
-                executed_commands.append(c.strip())
-
-        # update previous_context, keep tail to limit prompt size
-        if previous_context:
-            previous_context = (previous_context + "\n" + paragraph).strip()
-        else:
-            previous_context = paragraph.strip()
-
-        if len(previous_context) > 1200:
-            previous_context = previous_context[-1200:]
+        previous_context = advance_context(previous_context, executed_commands, paragraph)
 
         if delay_between:
             time.sleep(delay_between)
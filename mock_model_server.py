@@ -0,0 +1,185 @@
+# mock_model_server.py
+"""
+Stand-in for the local model server (OpenAI-compatible /v1/chat/completions).
+
+Simulates a fixed number of parallel slots, prompt-processing time proportional
+to prompt length, and per-token generation delay, and answers each of the
+pipeline's prompts with a plausible canned response. Used by loadgen.py.
+Requests with "cache_prompt" and "id_slot" reuse the common prefix with that
+slot's previous prompt, and report it like llama.cpp (timings.prompt_n / cache_n);
+any other request run in that slot evicts it.
+
+Run: python mock_model_server.py [--port 8000] [--slots 2] [--token-ms 20] [--prompt-ms-per-kchar 30]
+"""
+import re
+import json
+import time
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from prompts import (
+    MODE_DETECTION_PROMPT, MODE_DETECTION_BATCH_PROMPT, GOAL_QUESTIONS_PROMPT, GOAL_SUMMARIZE_PROMPT,
+    PHASE_PLANNING_PROMPT, PHASE_ADAPT_PROMPT, MICRO_TASK_PROMPT, KNOWN_ANSWERS_PROMPT,
+)
+from mode_detector import PHRASE_REGEX
+
+CONFIG = {"slots": 2, "token_ms": 20.0, "prompt_ms_per_kchar": 30.0}
+SLOTS = threading.BoundedSemaphore(CONFIG["slots"])
+SLOT_CACHE = {}          # id_slot -> serialized prompt last processed in that slot
+CHARS_PER_TOKEN = 4
+
+
+def _classify(message: str):
+    return "phase" if PHRASE_REGEX.search(message) or "?" not in message else "normal"
+
+
+def _canned_reply(prompt: str):
+    if prompt.startswith(MODE_DETECTION_PROMPT):
+        return _classify(prompt[len(MODE_DETECTION_PROMPT):])
+    if prompt.startswith(MODE_DETECTION_BATCH_PROMPT):
+        items = re.findall(r"^\d+\. (.*)$", prompt[len(MODE_DETECTION_BATCH_PROMPT):], flags=re.MULTILINE)
+        return json.dumps([_classify(item) for item in items])
+    if prompt.startswith(GOAL_QUESTIONS_PROMPT):
+        questions = [
+            {"id": 1, "question": "Which language do you want to use?", "type": "choice", "choices": ["python", "javascript"]},
+            {"id": 2, "question": "Should it run locally?", "type": "choice", "choices": ["yes (host locally)", "no"]},
+        ]
+        # like a real model, leave out what the user is already known to want
+        known = prompt.split(KNOWN_ANSWERS_PROMPT, 1)[1] if KNOWN_ANSWERS_PROMPT in prompt else ""
+        return json.dumps([q for q in questions if q["question"] not in known])
+    if prompt.startswith(GOAL_SUMMARIZE_PROMPT):
+        goal = re.search(r"Original Goal: (.*)", prompt[len(GOAL_SUMMARIZE_PROMPT):])
+        return f"{goal.group(1).strip() if goal else 'Create a project'} locally in the terminal using a venv."
+    if prompt.startswith(PHASE_PLANNING_PROMPT) or prompt.startswith(PHASE_ADAPT_PROMPT):
+        return json.dumps(["Create project folder", "Create main.py file", "Write starter code to main.py",
+                           "Initialize virtual environment", "Run main script"])
+    if prompt.startswith(MICRO_TASK_PROMPT):
+        phase = re.search(r"Phase: (.*)", prompt)
+        name = phase.group(1).strip() if phase else "step"
+        slug = re.sub(r"[^a-z0-9]+", "_", name.lower()).strip("_") or "step"
+        return f"Continuing from the previous step, this phase ({name}) is carried out with <cmd>mkdir -p {slug}</cmd> and then <cmd>ls {slug}</cmd>."
+    return "This is a mock chat answer. " * 8
+
+
+def _prompt_cost(payload):
+    """Return (prompt_tokens, cached_tokens) for a request, updating the slot cache."""
+    key = json.dumps(payload.get("messages", []), ensure_ascii=False)
+    cached_chars = 0
+    slot = payload.get("id_slot")
+    if slot is not None:
+        previous = SLOT_CACHE.get(slot, "")
+        while payload.get("cache_prompt") and cached_chars < min(len(previous), len(key)) \
+                and previous[cached_chars] == key[cached_chars]:
+            cached_chars += 1
+        # whatever ran in the slot last is what its cache holds
+        SLOT_CACHE[slot] = key
+    return len(key) // CHARS_PER_TOKEN, cached_chars // CHARS_PER_TOKEN
+
+
+def _tokens(text: str):
+    return re.findall(r"\S+\s*|\s+", text)
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", "0") or 0)
+        try:
+            payload = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            self.send_error(400)
+            return
+        if self.path.rstrip("/").endswith("/completions") and not self.path.rstrip("/").endswith("chat/completions"):
+            self._completions(payload)
+            return
+        messages = payload.get("messages", [])
+        prompt = messages[-1]["content"] if messages else ""
+        prompt_tokens, cached_tokens = _prompt_cost(payload)
+        usage = {"prompt_tokens": prompt_tokens, "prompt_tokens_details": {"cached_tokens": cached_tokens}}
+        timings = {"prompt_n": prompt_tokens - cached_tokens, "cache_n": cached_tokens}
+        reply = _canned_reply(prompt)
+        tokens = _tokens(reply)
+        finish_reason = "stop"
+        max_tokens = payload.get("max_tokens", -1)
+        if isinstance(max_tokens, int) and 0 < max_tokens < len(tokens):
+            tokens = tokens[:max_tokens]
+            finish_reason = "length"
+
+        with SLOTS:
+            evaluated_chars = (prompt_tokens - cached_tokens) * CHARS_PER_TOKEN
+            time.sleep(CONFIG["prompt_ms_per_kchar"] * evaluated_chars / 1000.0 / 1000.0)
+            usage["completion_tokens"] = len(tokens)
+            if payload.get("stream"):
+                self._stream(tokens, usage, timings, finish_reason)
+            else:
+                time.sleep(CONFIG["token_ms"] * len(tokens) / 1000.0)
+                body = json.dumps({
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(tokens)},
+                                 "finish_reason": finish_reason}],
+                    "usage": usage,
+                    "timings": timings,
+                }).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+    def _completions(self, payload):
+        """/v1/completions with a single prompt or a list of prompts, decoded in parallel in one slot batch."""
+        prompts = payload.get("prompt", "")
+        prompts = prompts if isinstance(prompts, list) else [prompts]
+        replies = [_tokens(_canned_reply(p.rsplit("\nOutput:", 1)[0])) for p in prompts]
+        with SLOTS:
+            chars = sum(len(p) for p in prompts)
+            time.sleep(CONFIG["prompt_ms_per_kchar"] * chars / 1000.0 / 1000.0)
+            time.sleep(CONFIG["token_ms"] * max((len(r) for r in replies), default=0) / 1000.0)
+        body = json.dumps({
+            "choices": [{"index": i, "text": "".join(r)} for i, r in enumerate(replies)],
+        }).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _stream(self, tokens, usage, timings, finish_reason="stop"):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        try:
+            for tok in tokens:
+                time.sleep(CONFIG["token_ms"] / 1000.0)
+                chunk = {"choices": [{"index": 0, "delta": {"content": tok}}]}
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+                self.wfile.flush()
+            final = {"choices": [{"index": 0, "delta": {}, "finish_reason": finish_reason}],
+                     "usage": usage, "timings": timings}
+            self.wfile.write(f"data: {json.dumps(final)}\n\n".encode("utf-8"))
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # client cancelled the stream; free the slot
+            pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mock OpenAI-compatible model server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--slots", type=int, default=CONFIG["slots"])
+    parser.add_argument("--token-ms", type=float, default=CONFIG["token_ms"])
+    parser.add_argument("--prompt-ms-per-kchar", type=float, default=CONFIG["prompt_ms_per_kchar"])
+    args = parser.parse_args()
+
+    CONFIG.update(slots=args.slots, token_ms=args.token_ms, prompt_ms_per_kchar=args.prompt_ms_per_kchar)
+    SLOTS = threading.BoundedSemaphore(args.slots)
+    print(f"Mock model server on http://{args.host}:{args.port} ({args.slots} slots)")
+    ThreadingHTTPServer((args.host, args.port), MockHandler).serve_forever()
@@ -1,9 +1,17 @@
 # mode_detector.py
-import requests
 import re
-from prompts import MODE_DETECTION_PROMPT
+import json
+import concurrent.futures
+from prompts import MODE_DETECTION_PROMPT, MODE_DETECTION_BATCH_PROMPT
+from scheduler import SCHEDULER, INTERACTIVE
+from micro_batch import MicroBatcher
+from budgets import BUDGETS
 
 API_URL = "http://localhost:8000/v1/chat/completions"
+COMPLETIONS_URL = "http://localhost:8000/v1/completions"
+
+# Set by enable_batching(); when None every detect_mode call is its own request
+MODE_BATCHER = None
 
 # regex to catch clear task/imperative phrases that indicate phase-mode
 PHRASE_REGEX = re.compile(
@@ -12,7 +20,6 @@ PHRASE_REGEX = re.compile(
 )
 
 def _call_model(user_input: str):
-    headers = {"Content-Type": "application/json"}
     payload = {
         "model": "local-model",
         "stream": False,
@@ -23,8 +30,11 @@ def _call_model(user_input: str):
         ]
     }
     try:
-        r = requests.post(API_URL, json=payload, headers=headers, timeout=10)
-        r.raise_for_status()
+        # the label is a few tokens; only the timeout is taken from the learned budget
+        with BUDGETS.track("detect_mode", max_tokens=8) as run:
+            r = SCHEDULER.post(API_URL, payload, priority=INTERACTIVE, timeout=run.timeout)
+            r.raise_for_status()
+            run.observe_response(r)
         data = r.json()
         # try chat completion format then fallback
         if "choices" in data and len(data["choices"]) > 0:
@@ -45,6 +55,82 @@ def _call_model(user_input: str):
         pass
     return None
 
+def _label(text):
+    text = (text or "").strip().strip('"').lower()
+    return text if text in ("phase", "normal") else None
+
+def _uncovered(labels):
+    """
+    Batch results for the callers' futures: an item the batch answer didn't cover
+    fails fast, and detect_mode makes that item's own request in the caller's
+    thread, so a failed batch costs one extra round-trip, not one per item.
+    """
+    return [lab if lab else LookupError("not covered by the batch answer") for lab in labels]
+
+def _batch_multi_prompt(inputs: list):
+    """One chat request classifying every input; answer is a JSON array of labels."""
+    if len(inputs) == 1:
+        return [_call_model(inputs[0])]
+    numbered = "\n".join(f"{i}. {json.dumps(text, ensure_ascii=False)}" for i, text in enumerate(inputs, start=1))
+    payload = {
+        "model": "local-model",
+        "stream": False,
+        "temperature": 0.0,
+        "max_tokens": 6 * len(inputs) + 8,
+        "messages": [
+            {"role": "user", "content": MODE_DETECTION_BATCH_PROMPT + numbered}
+        ]
+    }
+    labels = None
+    try:
+        r = SCHEDULER.post(API_URL, payload, priority=INTERACTIVE, timeout=10)
+        r.raise_for_status()
+        content = r.json()["choices"][0]["message"]["content"]
+        m = re.search(r'\[.*\]', content, flags=re.DOTALL)
+        parsed = json.loads(m.group(0)) if m else None
+        if isinstance(parsed, list) and len(parsed) == len(inputs):
+            labels = [_label(str(x)) for x in parsed]
+    except Exception:
+        pass
+    if labels is None:
+        labels = [None] * len(inputs)
+    return _uncovered(labels)
+
+def _batch_endpoint(inputs: list):
+    """One /v1/completions request with a list of prompts; the server decodes them in parallel."""
+    payload = {
+        "model": "local-model",
+        "temperature": 0.0,
+        "max_tokens": 8,
+        "prompt": [MODE_DETECTION_PROMPT + text + "\nOutput:" for text in inputs],
+    }
+    results = [None] * len(inputs)
+    try:
+        # same server slots as the chat endpoint
+        r = SCHEDULER.post(COMPLETIONS_URL, payload, priority=INTERACTIVE, timeout=10, endpoint=API_URL)
+        r.raise_for_status()
+        for i, choice in enumerate(r.json().get("choices", [])):
+            idx = choice.get("index", i)
+            if 0 <= idx < len(inputs):
+                words = (choice.get("text") or "").split()
+                results[idx] = _label(words[0]) if words else None
+    except Exception:
+        pass
+    return _uncovered(results)
+
+def enable_batching(max_wait_ms: float = 5, max_batch: int = 16, strategy: str = "prompt"):
+    """
+    Micro-batch detect_mode model calls from concurrent sessions.
+    strategy "prompt": one multi-item prompt with a JSON array answer;
+    strategy "endpoint": one multi-prompt request to the server's completions endpoint.
+    max_wait_ms bounds the latency added while a batch fills; items the batch
+    answer misses are retried individually (and concurrently) by their callers.
+    """
+    global MODE_BATCHER
+    handler = _batch_endpoint if strategy == "endpoint" else _batch_multi_prompt
+    MODE_BATCHER = MicroBatcher(handler, max_wait=max_wait_ms / 1000.0, max_batch=max_batch)
+    return MODE_BATCHER
+
 def detect_mode(user_input: str) -> str:
     """
     Return 'phase' or 'normal'.
@@ -59,8 +145,17 @@ def detect_mode(user_input: str) -> str:
         # If obvious task wording, return phase immediately
         return "phase"
 
-    # Otherwise call model for classification
-    model_out = _call_model(text)
+    # Otherwise call model for classification (batched with other sessions if enabled)
+    if MODE_BATCHER is not None:
+        try:
+            model_out = MODE_BATCHER(text, timeout=15)
+        except concurrent.futures.TimeoutError:
+            model_out = None
+        except Exception:
+            # the batch answer didn't cover this input: ask on our own
+            model_out = _call_model(text)
+    else:
+        model_out = _call_model(text)
     if model_out in ("phase", "normal"):
         return model_out
 
@@ -1,60 +1,138 @@
 # phase_init.py
-import requests
 import json
 import re
 import ast
 
-from prompts import PHASE_PLANNING_PROMPT
+import requests
+
+from prompts import PHASE_PLANNING_PROMPT, PHASE_ADAPT_PROMPT
+from scheduler import SCHEDULER, NORMAL, Cancelled
+from budgets import BUDGETS
 
 API_URL = "http://localhost:8000/v1/chat/completions"
 
 YELLOW = "\033[33m"
 RESET = "\033[0m"
 
+# Generic plan used when a deadline leaves no time to plan
+FALLBACK_PHASES = ["Set up the project", "Implement the core functionality", "Test and run it"]
+
+
+class PhaseList(list):
+    """
+    Phase titles as returned by Phase.init / Phase.adapt. complete is False when
+    they don't come from a full model answer (FALLBACK_PHASES, an answer cut off
+    by the deadline or a stream error), so callers shouldn't cache them.
+    """
+    complete = True
+
+
 class Phase:
     @staticmethod
-    def init(user_task: str, temperature: float = 0.7, max_tokens: int = -1):
+    def init(user_task: str, temperature: float = 0.7, max_tokens: int = None, deadline=None):
         """
         Streams response from local model but does not print intermediate tokens.
         At the end it parses and prints ONLY a Python list of short phase titles.
+        max_tokens defaults to the learned budget of the "phases" stage.
+        With a deadline that leaves no time (or cuts the answer off), or when the
+        stream fails before any phase arrived, FALLBACK_PHASES are used.
         """
 
         # Build the final prompt (prompt + user task)
         prompt_text = PHASE_PLANNING_PROMPT + user_task
 
-        headers = {"Content-Type": "application/json"}
-        payload = {
-            "model": "local-model",
-            "stream": True,
-            "temperature": temperature,
-            "max_tokens": max_tokens,
-            "messages": [
-                {"role": "system", "content": "You are a helpful assistant."},
-                {"role": "user", "content": prompt_text}
-            ],
-        }
+        buffer, complete = "", False
+        if deadline is None or deadline.allows():
+            buffer, complete = Phase._stream_collect(prompt_text, temperature, max_tokens, "phases", deadline)
+        final = PhaseList(Phase._parse_phase_list(buffer))
+        if (deadline is not None or not complete) and not any(final):
+            final = PhaseList(FALLBACK_PHASES)
+        final.complete = complete
+
+        # Print only the Python list (single line)
+        print(f"\n{YELLOW}{final}{RESET}\n")
+        return final
+
+    @staticmethod
+    def adapt(user_task: str, phases: list, temperature: float = 0.2, max_tokens: int = None, deadline=None):
+        """
+        Lightly edit a previously generated phase list so it fits user_task,
+        instead of planning from scratch. Falls back to the given phases if the
+        model output cannot be parsed or is incomplete (deadline, stream error).
+        """
+        prompt_text = (
+            PHASE_ADAPT_PROMPT
+            + f"Existing Phases: {json.dumps(list(phases), ensure_ascii=False)}\n"
+            + f"User Task: {user_task}"
+        )
+
+        buffer, complete = "", False
+        if deadline is None or deadline.allows():
+            buffer, complete = Phase._stream_collect(prompt_text, temperature, max_tokens, "phase_adapt", deadline)
+        final = PhaseList(Phase._parse_phase_list(buffer) if complete else [])
+        if not any(final):
+            final = PhaseList(phases)
+        final.complete = complete
 
+        print(f"\n{YELLOW}{final}{RESET}\n")
+        return final
+
+    @staticmethod
+    def _stream_collect(prompt_text: str, temperature: float, max_tokens: int, stage: str, deadline=None):
+        """
+        Collect a streamed answer silently. Returns (text, complete); complete is
+        False when the answer was cut off (time/token budget), the stream failed
+        or no server slot was free before the deadline.
+        """
         # Collect streamed tokens silently
         buffer = ""
+        complete = False
 
-        with requests.post(API_URL, json=payload, headers=headers, stream=True) as r:
-            for raw in r.iter_lines():
-                if not raw:
-                    continue
-                if not raw.startswith(b"data: "):
-                    continue
-                data = raw[len(b"data: "):]
-                if data == b"[DONE]":
-                    break
-                try:
-                    msg = json.loads(data.decode())
-                    token = msg["choices"][0]["delta"].get("content", "")
-                    if token:
-                        buffer += token
-                except Exception:
-                    # ignore malformed chunks
-                    continue
+        try:
+            with BUDGETS.track(stage, max_tokens=max_tokens, deadline=deadline) as run:
+                payload = {
+                    "model": "local-model",
+                    "stream": True,
+                    "temperature": temperature,
+                    "max_tokens": run.max_tokens,
+                    "messages": [
+                        {"role": "system", "content": "You are a helpful assistant."},
+                        {"role": "user", "content": prompt_text}
+                    ],
+                }
+
+                with SCHEDULER.stream(API_URL, payload, priority=NORMAL, timeout=run.timeout,
+                                      queue_timeout=run.queue_timeout) as ticket:
+                    run.start()
+                    for raw in ticket.iter_lines():
+                        if not raw:
+                            continue
+                        if not raw.startswith(b"data: "):
+                            continue
+                        data = raw[len(b"data: "):]
+                        if data == b"[DONE]" or run.expired():
+                            break
+                        try:
+                            msg = json.loads(data.decode())
+                            run.observe(msg)
+                            token = msg["choices"][0]["delta"].get("content", "")
+                            if token:
+                                buffer += token
+                        except Exception:
+                            # ignore malformed chunks
+                            continue
+                complete = not (run.timed_out or run.hit_limit)
+        except requests.exceptions.RequestException as e:
+            print(f"\n❌ Stream error: {e}\n")
+        except Cancelled:
+            # no server slot before the deadline
+            pass
 
+        return buffer, complete
+
+    @staticmethod
+    def _parse_phase_list(buffer: str):
+        """Parse model output into a normalized list of short phase titles."""
         # Try parse: 1) extract bracketed list substring, 2) json.loads -> ast.literal_eval -> fallback extract lines
         cleaned = buffer.strip()
 
@@ -125,6 +203,4 @@ class Phase:
             p = re.sub(r'\s+', ' ', p)
             final.append(p)
 
-        # Print only the Python list (single line)
-        print(f"\n{YELLOW}{final}{RESET}\n")
         return final
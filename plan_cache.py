@@ -0,0 +1,180 @@
+# plan_cache.py
+import os
+import re
+import json
+import time
+import random
+import hashlib
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".e_zero")
+INDEX_PATH = os.path.join(CACHE_DIR, "plan_index.json")
+
+NUM_PERM = 64          # MinHash signature length
+SHINGLE_SIZE = 4       # character shingles
+_PRIME = (1 << 61) - 1
+
+# words that carry no meaning for "is this the same goal" comparisons
+STOPWORDS = {
+    "a", "an", "the", "to", "in", "on", "for", "with", "and", "or", "of", "my", "me",
+    "i", "it", "that", "this", "using", "use", "please", "want", "would", "like",
+    "locally", "local", "basic", "simple", "new",
+}
+
+# collapse common verb/noun variants so "set up a flask project" ~ "create a flask app"
+SYNONYMS = {
+    "create": "make", "build": "make", "setup": "make", "set": "make", "up": "",
+    "initialize": "make", "initialise": "make", "scaffold": "make", "bootstrap": "make",
+    "generate": "make", "start": "make",
+    "app": "project", "application": "project", "repo": "project", "repository": "project",
+    "website": "site", "webpage": "site",
+    "py": "python", "python3": "python",
+    "js": "javascript", "node": "nodejs",
+}
+
+# fixed seeds so signatures stay comparable across runs
+_rng = random.Random(1337)
+_PERMS = [(_rng.randrange(1, _PRIME), _rng.randrange(0, _PRIME)) for _ in range(NUM_PERM)]
+
+
+def normalize_goal(text: str):
+    """Lowercase, drop stopwords and map synonyms to a canonical word."""
+    words = []
+    for w in re.findall(r"[a-z0-9.+#]+", (text or "").lower()):
+        w = w.strip(".")
+        w = SYNONYMS.get(w, w)
+        if w and w not in STOPWORDS:
+            words.append(w)
+    return " ".join(words)
+
+
+def shingles(text: str, k: int = SHINGLE_SIZE):
+    """Character k-shingles of the normalized text (plus whole words for short inputs)."""
+    norm = normalize_goal(text)
+    out = set(norm.split())
+    for i in range(max(len(norm) - k + 1, 0)):
+        out.add(norm[i:i + k])
+    return out
+
+
+def _hash_shingle(s: str):
+    return int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+def minhash_signature(text: str):
+    """Return a MinHash signature (list of NUM_PERM ints) for text."""
+    hashes = [_hash_shingle(s) for s in shingles(text)]
+    if not hashes:
+        return [_PRIME] * NUM_PERM
+    return [min((a * h + b) % _PRIME for h in hashes) for a, b in _PERMS]
+
+
+def signature_similarity(sig_a, sig_b):
+    """Estimated Jaccard similarity of two signatures."""
+    if not sig_a or not sig_b or len(sig_a) != len(sig_b):
+        return 0.0
+    same = sum(1 for x, y in zip(sig_a, sig_b) if x == y)
+    return same / len(sig_a)
+
+
+def goal_similarity(a: str, b: str):
+    """Exact Jaccard similarity of the shingle sets of two goals."""
+    sa, sb = shingles(a), shingles(b)
+    if not sa or not sb:
+        return 0.0
+    return len(sa & sb) / len(sa | sb)
+
+
+class PlanIndex:
+    """
+    Small persistent index of past refined goals -> phase lists.
+    Lookup is a nearest-neighbour scan over MinHash signatures, confirmed with
+    the exact shingle Jaccard. Size is bounded; least recently used entries are evicted.
+    """
+
+    def __init__(self, path: str = INDEX_PATH, max_entries: int = 200, threshold: float = 0.6):
+        self.path = path
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.entries = []
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            self.entries = [e for e in data.get("entries", []) if isinstance(e, dict) and e.get("phases")]
+        except (OSError, ValueError):
+            self.entries = []
+
+    def save(self):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = self.path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"entries": self.entries}, f, ensure_ascii=False)
+            os.replace(tmp, self.path)
+        except OSError:
+            # the index is only an optimisation; never fail the pipeline over it
+            pass
+
+    def lookup(self, goal: str, threshold: float = None):
+        """
+        Return (entry, similarity) for the closest past goal, or None if nothing
+        is at least `threshold` similar.
+        """
+        threshold = self.threshold if threshold is None else threshold
+        if not self.entries:
+            return None
+        sig = minhash_signature(goal)
+        # rank by estimated similarity, then confirm the best few exactly
+        ranked = sorted(self.entries, key=lambda e: signature_similarity(sig, e.get("signature")), reverse=True)
+        best, best_sim = None, 0.0
+        for entry in ranked[:5]:
+            sim = goal_similarity(goal, entry["goal"])
+            if sim > best_sim:
+                best, best_sim = entry, sim
+        if best is None or best_sim < threshold:
+            return None
+        best["last_used"] = time.time()
+        best["hits"] = best.get("hits", 0) + 1
+        self.save()
+        return best, best_sim
+
+    def add(self, goal: str, phases: list):
+        """Store phases for goal, replacing a near-identical entry if present."""
+        if not goal or not phases:
+            return
+        now = time.time()
+        sig = minhash_signature(goal)
+        for entry in self.entries:
+            if goal_similarity(goal, entry["goal"]) >= 0.95:
+                entry.update({"goal": goal, "phases": list(phases), "signature": sig, "last_used": now})
+                self.save()
+                return
+        self.entries.append({
+            "goal": goal,
+            "phases": list(phases),
+            "signature": sig,
+            "created": now,
+            "last_used": now,
+            "hits": 0,
+        })
+        self._evict()
+        self.save()
+
+    def _evict(self):
+        """Drop least recently used entries until the index fits max_entries."""
+        if len(self.entries) <= self.max_entries:
+            return
+        self.entries.sort(key=lambda e: e.get("last_used", 0), reverse=True)
+        del self.entries[self.max_entries:]
+
+    def remove(self, goal: str):
+        before = len(self.entries)
+        self.entries = [e for e in self.entries if e["goal"] != goal]
+        if len(self.entries) != before:
+            self.save()
+
+    def clear(self):
+        self.entries = []
+        self.save()
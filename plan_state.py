@@ -0,0 +1,240 @@
+# plan_state.py
+import os
+import re
+import json
+import hashlib
+import difflib
+
+from micro_tasks import generate_micro_task_stream, advance_context, _extract_cmds, _normalize_cmd
+from plan_cache import CACHE_DIR, goal_similarity
+
+PLAN_PATH = os.path.join(CACHE_DIR, "last_plan.json")
+
+# goal edits at least this similar keep unchanged phases; below it everything is regenerated
+GOAL_EDIT_THRESHOLD = 0.8
+# how many preceding phases' prose a microtask sees (the prompt keeps only the last
+# ~900 chars of context); the commands it is shown come from every earlier phase and
+# are compared in full (see build_plan)
+CONTEXT_DEPTH = 1
+
+# words too common to tie a goal edit to a phase
+STOPWORDS = {
+    "a", "an", "the", "and", "or", "of", "to", "in", "on", "for", "with", "by", "at", "as", "is",
+    "it", "be", "that", "this", "use", "using", "should", "will", "can", "app", "project",
+}
+
+# ANSI colors
+YELLOW = "\033[33m"
+RESET = "\033[0m"
+
+
+def _fingerprint(*parts):
+    h = hashlib.sha1()
+    for p in parts:
+        h.update(json.dumps(p, sort_keys=True, ensure_ascii=False).encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()[:16]
+
+
+def _norm_title(title: str):
+    return re.sub(r"\s+", " ", (title or "").strip().lower())
+
+
+def _terms(text: str):
+    return {t.strip(".:/-").lower() for t in re.findall(r"[\w.:/-]+", text or "")} - STOPWORDS - {""}
+
+
+def goal_edit(old_goal: str, new_goal: str):
+    """(removed, added) terms between two versions of the refined goal."""
+    old, new = _terms(old_goal), _terms(new_goal)
+    return old - new, new - old
+
+
+def _touched_by_goal_edit(phase: dict, removed: set, added: set):
+    """
+    True if a goal edit may change this phase's microtask: its text mentions a
+    removed term (e.g. the old port number), or its title an added one.
+    """
+    return bool(_terms(phase["title"] + "\n" + phase["paragraph"]) & removed or _terms(phase["title"]) & added)
+
+
+def output_fingerprint(paragraph: str):
+    """What later phases depend on: the commands a paragraph runs (prose is ignored)."""
+    return _fingerprint([_normalize_cmd(c) for c in _extract_cmds(paragraph or "")])
+
+
+class Plan:
+    """
+    A phase-mode plan: refined goal, Q&A, and per phase the title, the inputs
+    its microtask was generated from, the paragraph and fingerprints of both.
+    """
+
+    def __init__(self, original_goal, refined_goal, qa=None, questions=None, phases=None):
+        self.original_goal = original_goal
+        self.refined_goal = refined_goal
+        self.qa = qa or []
+        self.questions = questions or []
+        self.phases = phases or []   # list of dicts, see _phase_record
+
+    @property
+    def titles(self):
+        return [p["title"] for p in self.phases]
+
+    @property
+    def paragraphs(self):
+        return [p["paragraph"] for p in self.phases]
+
+    def to_dict(self):
+        return {
+            "original_goal": self.original_goal,
+            "refined_goal": self.refined_goal,
+            "qa": self.qa,
+            "questions": self.questions,
+            "phases": self.phases,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data.get("original_goal", ""), data.get("refined_goal", ""),
+                   data.get("qa"), data.get("questions"), data.get("phases"))
+
+    def save(self, path: str = PLAN_PATH):
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(self.to_dict(), f, ensure_ascii=False, indent=1)
+        except OSError:
+            pass
+
+    @classmethod
+    def load(cls, path: str = PLAN_PATH):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return cls.from_dict(json.load(f))
+        except (OSError, ValueError):
+            return None
+
+
+def _command_set(commands):
+    return {_normalize_cmd(c) for c in commands} - {""}
+
+
+def _input_fingerprint(title, goal, previous_context, executed_commands):
+    return _fingerprint(_norm_title(title), goal, previous_context, list(executed_commands))
+
+
+def _phase_record(title, goal, previous_context, executed_commands, paragraph, status):
+    return {
+        "title": title,
+        "inputs": {
+            "goal": goal,
+            "previous_context": previous_context,
+            "executed_commands": list(executed_commands),
+        },
+        "input_fingerprint": _input_fingerprint(title, goal, previous_context, executed_commands),
+        "paragraph": paragraph,
+        "output_fingerprint": output_fingerprint(paragraph),
+        "status": status,
+    }
+
+
+def build_plan(result: dict, titles: list, old_plan: Plan = None, questions: list = None,
+               context_depth: int = CONTEXT_DEPTH, on_token=None, deadline=None):
+    """
+    Build a Plan for refine result + phase titles, reusing microtasks from old_plan
+    wherever they are still valid. With no old_plan every phase is generated.
+
+    A kept phase must:
+    - match an old phase in the title diff (difflib over normalized titles),
+    - have the same matched predecessors within context_depth,
+    - have none of those predecessors regenerated with different commands,
+    - have been generated with the same commands of all earlier phases (the prompt
+      lists every command run so far, not just the predecessors'),
+    - have no command that an earlier phase now already runs,
+    - have the same inputs (input_fingerprint), or not be touched by the edit of the
+      goal it was generated from (goal_edit: no removed term in its title/paragraph,
+      no added term in its title).
+    A goal edit below GOAL_EDIT_THRESHOLD similarity invalidates everything.
+    A regenerated phase whose commands come out the same does not invalidate later phases.
+    Each phase record gets "status": "kept", "generated" or "skipped".
+    on_token is passed through like in generate_microtasks_for_phases: on_token(phase, token).
+    With a deadline every phase to generate gets an equal share of the time left; once too
+    little is left the remaining phases are "skipped" (kept phases still count).
+    """
+    goal = result["refined_goal_paragraph"]
+
+    mapping = {}
+    goal_ok = False
+    if old_plan is not None and old_plan.phases:
+        goal_ok = goal_similarity(goal, old_plan.refined_goal) >= GOAL_EDIT_THRESHOLD
+        matcher = difflib.SequenceMatcher(a=[_norm_title(t) for t in old_plan.titles],
+                                          b=[_norm_title(t) for t in titles], autojunk=False)
+        for block in matcher.get_matching_blocks():
+            for n in range(block.size):
+                mapping[block.b + n] = block.a + n
+
+    previous_context = ""
+    executed_commands = []
+    changed = set()       # new indices whose output differs from what old dependants saw
+    records = []
+
+    for i, title in enumerate(titles):
+        k = mapping.get(i) if goal_ok else None
+        valid = k is not None
+        if valid:
+            for d in range(1, context_depth + 1):
+                if i - d < 0 and k - d < 0:
+                    break
+                if i - d < 0 or mapping.get(i - d) != k - d or (i - d) in changed:
+                    valid = False
+                    break
+        if valid and old_plan.phases[k]["status"] == "skipped":
+            valid = False
+        if valid and _command_set(old_plan.phases[k]["inputs"]["executed_commands"]) != _command_set(
+                executed_commands):
+            valid = False
+        if valid and old_plan.phases[k]["input_fingerprint"] != _input_fingerprint(
+                title, goal, previous_context, executed_commands):
+            # the goal the paragraph was generated from, not just the latest one
+            removed, added = goal_edit(old_plan.phases[k]["inputs"]["goal"], goal)
+            if _touched_by_goal_edit(old_plan.phases[k], removed, added):
+                valid = False
+        if valid:
+            executed = {_normalize_cmd(c) for c in executed_commands}
+            old_cmds = [_normalize_cmd(c) for c in _extract_cmds(old_plan.phases[k]["paragraph"])]
+            if any(c in executed for c in old_cmds):
+                valid = False
+
+        if valid:
+            old = old_plan.phases[k]
+            # a kept phase keeps the inputs its paragraph was generated from
+            record = dict(old, title=title, status="kept")
+            if on_token is None:
+                print(f"\n{YELLOW}--- Micro Task: {title} (unchanged) ---{RESET}\n\n{old['paragraph']}\n")
+        elif deadline is not None and not deadline.allows():
+            records.append(_phase_record(title, goal, previous_context, executed_commands, "", "skipped"))
+            changed.add(i)
+            continue
+        else:
+            phase_on_token = None
+            if on_token is not None:
+                phase_on_token = lambda token, ph=title: on_token(ph, token)
+            paragraph = generate_micro_task_stream(goal, title, previous_context, executed_commands,
+                                                   on_token=phase_on_token,
+                                                   deadline=deadline and deadline.share(len(titles) - i))
+            record = _phase_record(title, goal, previous_context, executed_commands, paragraph, "generated")
+            if k is None or record["output_fingerprint"] != old_plan.phases[k]["output_fingerprint"]:
+                changed.add(i)
+        records.append(record)
+        previous_context = advance_context(previous_context, executed_commands, record["paragraph"])
+
+    return Plan(result.get("original_goal", goal), goal, result.get("qa"),
+                questions if questions is not None else result.get("questions"), records)
+
+
+def plan_summary(plan: Plan):
+    """(kept, generated, skipped) phase counts."""
+    counts = {"kept": 0, "generated": 0, "skipped": 0}
+    for p in plan.phases:
+        counts[p["status"]] += 1
+    return counts["kept"], counts["generated"], counts["skipped"]
@@ -0,0 +1,197 @@
+# preferences.py
+import os
+import re
+import json
+import time
+import threading
+import collections
+
+from plan_cache import CACHE_DIR, normalize_goal, goal_similarity
+
+PREFS_PATH = os.path.join(CACHE_DIR, "preferences.json")
+
+PREFILL_SIMILARITY = 0.6     # similar enough to show the remembered answer as the default
+CONFIDENT_SIMILARITY = 0.85  # similar enough to answer without asking...
+CONFIDENT_COUNT = 2          # ...if given at least this often
+CONFIDENT_SHARE = 0.8        # ...and at least this share of the time
+GOAL_SIMILARITY = 0.8        # a past goal this similar lets the question request be skipped
+MAX_KNOWN = 8                # known answers passed to the question generator
+MAX_GOALS = 200
+
+
+def _norm_question(text: str):
+    return re.sub(r"\s+", " ", re.sub(r"[^\w\s]", " ", (text or "").lower())).strip()
+
+
+def _match_choice(answer: str, choices: list):
+    """The current choice matching a remembered answer, or None."""
+    if not choices:
+        return answer
+    norm = normalize_goal(answer)
+    for choice in choices:
+        if normalize_goal(choice) == norm:
+            return choice
+    best = max(choices, key=lambda c: goal_similarity(c, answer))
+    return best if goal_similarity(best, answer) >= 0.8 else None
+
+
+class PreferenceStore:
+    """
+    Per-user memory of answers to clarifying questions.
+
+    Answers are indexed by normalized question text and matched by shingle
+    similarity (plan_cache.goal_similarity), so "Which language do you want
+    to use?" also finds "What language should it use?".
+    - suggest(q) gives a remembered answer: shown as the default, or used
+      without asking once it has been given consistently (see CONFIDENT_*)
+    - known_answers(goal) is passed to the question generator so it can skip them;
+      only questions asked for similar past goals count, so a settled "Which Python
+      framework?" doesn't leak into an unrelated goal
+    - questions_for(goal) returns the questions of a similar past goal when all
+      of them can be answered confidently, so the question request is skipped
+    - metrics counts question requests made/skipped, questions asked/auto-answered
+      and the time spent answering (filled in by goal_refine)
+    """
+
+    def __init__(self, user: str = None, path: str = None):
+        if path is None:
+            path = PREFS_PATH if not user else os.path.join(
+                CACHE_DIR, f"preferences-{re.sub(r'[^A-Za-z0-9_.-]', '_', user)}.json")
+        self.path = path
+        self._lock = threading.Lock()
+        data = self._load()
+        self.entries = data.get("entries", [])    # {"question", "norm", "answers": {answer: count}, "updated"}
+        self.goals = data.get("goals", [])        # {"goal", "questions": [...]} most recent last
+        self.metrics = collections.Counter(data.get("metrics", {}))
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save(self):
+        with self._lock:
+            data = json.dumps({"entries": self.entries, "goals": self.goals, "metrics": dict(self.metrics)},
+                              ensure_ascii=False)
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = self.path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(data)
+            os.replace(tmp, self.path)
+        except OSError:
+            pass
+
+    def clear(self):
+        with self._lock:
+            self.entries, self.goals = [], []
+        self.save()
+
+    # ---- lookup ---------------------------------------------------------
+
+    def _find(self, question: str):
+        """(entry, similarity) of the most similar remembered question, or (None, 0)."""
+        norm = _norm_question(question)
+        best, best_sim = None, 0.0
+        for entry in self.entries:
+            sim = 1.0 if entry["norm"] == norm else goal_similarity(entry["norm"], norm)
+            if sim > best_sim:
+                best, best_sim = entry, sim
+        return best, best_sim
+
+    def suggest(self, q: dict):
+        """
+        (answer, confident) for question dict q, or (None, False).
+        For choice questions the answer is mapped onto q's current choices.
+        """
+        with self._lock:
+            entry, sim = self._find(q["question"])
+            if entry is None or sim < PREFILL_SIMILARITY:
+                return None, False
+            answers = dict(entry["answers"])
+        total = sum(answers.values())
+        top, count = max(answers.items(), key=lambda kv: kv[1])
+        answer = _match_choice(top, q.get("choices") or [])
+        if answer is None:
+            return None, False
+        confident = sim >= CONFIDENT_SIMILARITY and count >= CONFIDENT_COUNT and count / total >= CONFIDENT_SHARE
+        return answer, confident
+
+    def known_answers(self, goal: str = None, limit: int = MAX_KNOWN):
+        """
+        [{"question", "answer"}] of settled preferences, most recently used first.
+        With a goal only questions asked for a past goal at least GOAL_SIMILARITY similar are included.
+        """
+        with self._lock:
+            entries = sorted(self.entries, key=lambda e: e["updated"], reverse=True)
+            if goal is not None:
+                related = set()
+                for past in self.goals:
+                    if goal_similarity(past["goal"], goal) < GOAL_SIMILARITY:
+                        continue
+                    for q in past["questions"]:
+                        entry, sim = self._find(q["question"])
+                        if entry is not None and sim >= CONFIDENT_SIMILARITY:
+                            related.add(id(entry))
+                entries = [e for e in entries if id(e) in related]
+        known = []
+        for entry in entries:
+            total = sum(entry["answers"].values())
+            top, count = max(entry["answers"].items(), key=lambda kv: kv[1])
+            if count >= CONFIDENT_COUNT and count / total >= CONFIDENT_SHARE:
+                known.append({"question": entry["question"], "answer": top})
+            if len(known) >= limit:
+                break
+        return known
+
+    def questions_for(self, goal: str):
+        """Questions asked for a similar past goal if every one has a confident answer, else None."""
+        with self._lock:
+            candidates = [g for g in self.goals if goal_similarity(g["goal"], goal) >= GOAL_SIMILARITY]
+        for past in reversed(candidates):
+            if past["questions"] and all(self.suggest(q)[1] for q in past["questions"]):
+                return [dict(q) for q in past["questions"]]
+        return None
+
+    def report(self):
+        """Per-goal averages: question requests, questions asked, seconds spent answering."""
+        with self._lock:
+            m = dict(self.metrics)
+        goals = m.get("goals", 0) or 1
+        return {
+            "goals": m.get("goals", 0),
+            "remembered": len(self.entries),
+            "question_requests_per_goal": m.get("question_requests", 0) / goals,
+            "question_requests_skipped": m.get("question_requests_skipped", 0),
+            "asked_per_goal": m.get("asked", 0) / goals,
+            "auto_answered_per_goal": m.get("auto_answered", 0) / goals,
+            "prefilled": m.get("prefilled", 0),
+            "prefill_accepted": m.get("prefill_accepted", 0),
+            "answer_seconds_per_goal": m.get("answer_seconds", 0.0) / goals,
+        }
+
+    # ---- learning -------------------------------------------------------
+
+    def record(self, q: dict, answer: str):
+        """Remember the answer given to question q."""
+        if not answer:
+            return
+        with self._lock:
+            entry, sim = self._find(q["question"])
+            if entry is None or sim < CONFIDENT_SIMILARITY:
+                entry = {"question": q["question"], "norm": _norm_question(q["question"]),
+                         "answers": {}, "updated": 0}
+                self.entries.append(entry)
+            entry["answers"][answer] = entry["answers"].get(answer, 0) + 1
+            entry["updated"] = time.time()
+
+    def record_goal(self, goal: str, questions: list):
+        """Remember which questions were asked for goal (see questions_for)."""
+        with self._lock:
+            self.goals.append({"goal": goal, "questions": [
+                {"question": q["question"], "type": q["type"], "choices": q["choices"]} for q in questions
+            ]})
+            del self.goals[:-MAX_GOALS]
+        self.save()
@@ -67,6 +67,12 @@ User Message:
 """
 
 
+KNOWN_ANSWERS_PROMPT = """
+
+Already known about this user (do NOT ask about these again; ask only what is still unclear, or output [] if nothing is):
+"""
+
+
 GOAL_SUMMARIZE_PROMPT = """
 You are a goal refinement assistant.
 
@@ -152,3 +158,39 @@ Your single-paragraph output must describe the transition from the previous step
 """
 
 
+
+PHASE_ADAPT_PROMPT = """
+You are a STRICT phase editor. You receive a list of phase titles that was generated for a similar task, and the new User Task.
+
+INSTRUCTIONS (follow exactly):
+1. Output ONLY a Python list (or valid JSON array) of phase titles (strings).
+2. Keep every existing phase that still applies, unchanged and in the same order.
+3. Only rename, add or remove phases where the new User Task actually differs (e.g. a different framework, language or file name).
+4. Follow the same rules as the original phases: one atomic terminal action per phase, 3–7 words, no numbering or commentary.
+
+"""
+
+CHAT_SUMMARY_PROMPT = """
+You are a conversation summarizer.
+
+Task:
+Merge the Existing summary and the New turns into ONE short summary paragraph (max 6 sentences).
+Rules:
+- Keep facts, names, decisions, code/file names and open questions the assistant may need later.
+- Drop greetings, filler and anything already superseded.
+- Output ONLY the summary paragraph (no headings, no lists, no commentary).
+
+"""
+
+MODE_DETECTION_BATCH_PROMPT = """
+You are a STRICT mode classifier. Classify EACH numbered user message independently.
+
+For each message:
+- "phase" ONLY if it clearly asks for task breakdowns, step-by-step instructions, learning roadmaps, multi-step procedures, or to create/build/setup/install/generate something.
+- Otherwise "normal". If ambiguous, choose "normal".
+
+Output ONLY a JSON array of strings, one per message, in the same order, each exactly "phase" or "normal".
+Example for 3 messages: ["phase","normal","normal"]
+
+Messages:
+"""
@@ -1,13 +1,64 @@
 # run_commands.py
 import re
-import subprocess
+import os
+import time
+import queue
 import shlex
+import signal
+import socket
+import atexit
+import threading
+import subprocess
+import collections
+
+from install_batch import batch_install_commands
+from snapshot import WorkspaceSnapshots
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
 
 # ANSI colors
 GREEN = "\033[32m"
 YELLOW = "\033[33m"
 RESET = "\033[0m"
 
+# Default per-command limits (override per call, None disables a limit)
+DEFAULT_TIMEOUT = 120          # wall-clock seconds
+DEFAULT_CPU_TIME = 60          # CPU seconds (RLIMIT_CPU)
+DEFAULT_MEMORY_MB = 4096       # data segment / heap (RLIMIT_DATA)
+READY_TIMEOUT = 15             # seconds a long-running command gets to become ready
+KILL_GRACE = 3                 # seconds between SIGTERM and SIGKILL
+
+# Commands that are expected to keep running (servers, watchers)
+LONG_RUNNING_REGEX = re.compile(
+    r"(flask\s+run|uvicorn|gunicorn|manage\.py\s+runserver|http\.server|"
+    r"npm\s+(run\s+)?(start|dev|serve)|yarn\s+(start|dev|serve)|next\s+dev|\bvite\b|nodemon|"
+    r"jupyter\s+(notebook|lab)|streamlit\s+run|php\s+-S|rails\s+s(erver)?\b|hugo\s+server)",
+    flags=re.IGNORECASE
+)
+
+# Output lines that show a process has finished starting up and will keep running
+READY_REGEX = re.compile(
+    r"(running on|listening on|serving http|server (is )?running|started server|"
+    r"development server at|application startup complete|local:\s+https?://|press ctrl\+c)",
+    flags=re.IGNORECASE
+)
+
+# Default ports used when the command does not name one
+DEFAULT_PORTS = [
+    (re.compile(r"flask\s+run", re.I), 5000),
+    (re.compile(r"uvicorn|gunicorn|runserver|http\.server", re.I), 8000),
+    (re.compile(r"\bvite\b|npm\s+run\s+dev|yarn\s+dev", re.I), 5173),
+    (re.compile(r"npm|yarn|next", re.I), 3000),
+    (re.compile(r"streamlit", re.I), 8501),
+    (re.compile(r"jupyter", re.I), 8888),
+]
+
+# Processes moved to the background: list of (command, Popen, output tail)
+BACKGROUND_PROCESSES = []
+
 
 def extract_commands(paragraph: str):
     """
@@ -17,45 +68,221 @@ def extract_commands(paragraph: str):
     return re.findall(r"<cmd>(.*?)</cmd>", paragraph, flags=re.DOTALL)
 
 
-def run_commands(commands: list):
+def _guess_port(cmd: str):
+    m = re.search(r"(?:--port[= ]|-p\s+|:)(\d{2,5})\b", cmd) or re.search(r"http\.server\s+(\d{2,5})\b", cmd)
+    if m:
+        return int(m.group(1))
+    for pattern, port in DEFAULT_PORTS:
+        if pattern.search(cmd):
+            return port
+    return None
+
+
+def _port_open(port: int):
+    try:
+        with socket.create_connection(("127.0.0.1", port), timeout=0.2):
+            return True
+    except OSError:
+        return False
+
+
+def _limit_setter(cpu_time, memory_mb):
+    """Build a preexec_fn that applies rlimits inside the child before exec."""
+    if resource is None or (cpu_time is None and memory_mb is None):
+        return None
+
+    def apply_limits():
+        if cpu_time is not None:
+            # hard limit stays open so a backgrounded server can have its soft limit lifted
+            resource.setrlimit(resource.RLIMIT_CPU, (cpu_time, resource.RLIM_INFINITY))
+        if memory_mb is not None:
+            # RLIMIT_DATA rather than RLIMIT_AS: runtimes like V8 reserve huge address ranges
+            limit = memory_mb * 1024 * 1024
+            resource.setrlimit(resource.RLIMIT_DATA, (limit, limit))
+
+    return apply_limits
+
+
+def _group_alive(pgid: int):
+    try:
+        os.killpg(pgid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except OSError:
+        return True
+
+
+def _kill_group(process):
     """
-    Execute commands one-by-one in the user's shell.
-    Prints output live.
+    Terminate the command's whole process group (SIGTERM, then SIGKILL).
+    The group is signalled even if the command itself already exited: a child
+    it started may still be running (and holding the output pipe).
     """
-    for cmd in commands:
-        clean_cmd = cmd.strip()  
+    pgid = process.pid  # start_new_session: the command leads its own group
+    try:
+        os.killpg(pgid, signal.SIGTERM)
+    except OSError:
+        process.poll()
+        return
+    end = time.monotonic() + KILL_GRACE
+    while time.monotonic() < end:
+        process.poll()  # reap the command so a zombie doesn't keep the group "alive"
+        if not _group_alive(pgid):
+            return
+        time.sleep(0.05)
+    try:
+        os.killpg(pgid, signal.SIGKILL)
+    except OSError:
+        pass
+    process.wait()
+
+
+def _pump_output(process, lines, tail, state):
+    """Reader thread: forward output lines until the command is moved to the background."""
+    for line in process.stdout:
+        tail.append(line)
+        if not state["background"]:
+            lines.put(line)
+    lines.put(None)
+
+
+def _move_to_background(cmd, process, tail, state):
+    state["background"] = True
+    if resource is not None and hasattr(resource, "prlimit"):
+        # servers accumulate CPU time forever; lift the soft CPU limit
+        try:
+            resource.prlimit(process.pid, resource.RLIMIT_CPU, (resource.RLIM_INFINITY, resource.RLIM_INFINITY))
+        except (OSError, ValueError):
+            pass
+    BACKGROUND_PROCESSES.append((cmd, process, tail))
 
-        print(f"\n{YELLOW}→ Running:{RESET} {GREEN}{clean_cmd}{RESET}")
+
+def stop_background_processes():
+    """Kill every command that was moved to the background."""
+    while BACKGROUND_PROCESSES:
+        cmd, process, _ = BACKGROUND_PROCESSES.pop()
+        if process.poll() is None or _group_alive(process.pid):
+            print(f"{YELLOW}■ Stopping background command:{RESET} {cmd}")
+        _kill_group(process)
+
+
+atexit.register(stop_background_processes)
+
+
+def run_command(cmd: str, timeout=DEFAULT_TIMEOUT, cpu_time=DEFAULT_CPU_TIME, memory_mb=DEFAULT_MEMORY_MB):
+    """
+    Run a single command in its own process group with rlimits applied.
+    - stdin is closed, so commands waiting for input fail instead of hanging
+    - on wall-clock timeout the whole process tree is killed
+    - long-running commands (servers) are moved to the background once a
+      readiness probe (open port or "listening on"-style output) succeeds
+      while the command is still running; the port probe is only used if
+      the port was free before the command started
+    Returns "ok", "failed", "timeout", "background" or "error".
+    """
+    long_running = bool(LONG_RUNNING_REGEX.search(cmd))
+    port = _guess_port(cmd) if long_running else None
+    if port and _port_open(port):
+        # something else already listens there; an open port says nothing about this command
+        print(f"{YELLOW}⚠ Port {port} is already in use — waiting for output instead{RESET}")
+        port = None
+
+    process = subprocess.Popen(
+        shlex.split(cmd),
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        bufsize=1,
+        start_new_session=True,
+        # a server must not be killed for using CPU over its lifetime
+        preexec_fn=_limit_setter(None if long_running else cpu_time, memory_mb),
+    )
+
+    lines = queue.Queue()
+    tail = collections.deque(maxlen=200)
+    state = {"background": False}
+    threading.Thread(target=_pump_output, args=(process, lines, tail, state), daemon=True).start()
+
+    start = time.monotonic()
+    while True:
+        elapsed = time.monotonic() - start
+        if timeout is not None and elapsed >= timeout:
+            _kill_group(process)
+            print(f"{YELLOW}⏱ Timed out after {timeout:g}s — process group killed{RESET}")
+            return "timeout"
 
         try:
-            # Run command and stream output
-            process = subprocess.Popen(
-                shlex.split(clean_cmd),
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True
-            )
+            line = lines.get(timeout=0.2)
+        except queue.Empty:
+            line = ""
+
+        if line is None:
+            break
+        if line:
+            print(line, end="")
+
+        ready = (line and READY_REGEX.search(line)) or (port and _port_open(port))
+        if ready and process.poll() is None:
+            _move_to_background(cmd, process, tail, state)
+            print(f"{GREEN}✓ Ready — running in background (pid {process.pid}){RESET}")
+            return "background"
+        if long_running and elapsed >= READY_TIMEOUT and process.poll() is None:
+            _move_to_background(cmd, process, tail, state)
+            print(f"{YELLOW}⚠ No readiness signal after {READY_TIMEOUT}s — left running in background (pid {process.pid}){RESET}")
+            return "background"
+
+    # output closed; wait for the exit status within what is left of the budget
+    remaining = None if timeout is None else max(timeout - (time.monotonic() - start), 0.1)
+    try:
+        process.wait(timeout=remaining)
+    except subprocess.TimeoutExpired:
+        _kill_group(process)
+        print(f"{YELLOW}⏱ Timed out after {timeout:g}s — process group killed{RESET}")
+        return "timeout"
+
+    if process.returncode == 0:
+        print(f"{GREEN}✓ Success{RESET}")
+        return "ok"
+    if process.returncode < 0 and -process.returncode in (signal.SIGXCPU, signal.SIGKILL):
+        print(f"{YELLOW}⚠ Command killed by resource limit (signal {-process.returncode}){RESET}")
+    else:
+        print(f"{YELLOW}⚠ Command exited with code {process.returncode}{RESET}")
+    return "failed"
 
-            # Forward stdout
-            for line in process.stdout:
-                print(line, end="")
 
-            # Forward stderr
-            for line in process.stderr:
-                print(line, end="")
+def run_commands(commands: list, timeout=DEFAULT_TIMEOUT, cpu_time=DEFAULT_CPU_TIME, memory_mb=DEFAULT_MEMORY_MB,
+                 deadline=None):
+    """
+    Execute commands one-by-one in the user's shell.
+    Prints output live. Returns a list of (command, status) tuples.
+    With a deadline each command's timeout is cut to the time left, and
+    commands that can no longer start get the status "skipped".
+    """
+    results = []
+    for cmd in commands:
+        clean_cmd = cmd.strip()
 
-            process.wait()
+        if deadline is not None and not deadline.allows(1):
+            print(f"{YELLOW}⏱ Skipped (deadline reached):{RESET} {clean_cmd}")
+            results.append((clean_cmd, "skipped"))
+            continue
 
-            if process.returncode == 0:
-                print(f"{GREEN}✓ Success{RESET}")
-            else:
-                print(f"{YELLOW}⚠ Command exited with code {process.returncode}{RESET}")
+        print(f"\n{YELLOW}→ Running:{RESET} {GREEN}{clean_cmd}{RESET}")
 
+        try:
+            status = run_command(clean_cmd, timeout=timeout if deadline is None else deadline.clamp(timeout),
+                                 cpu_time=cpu_time, memory_mb=memory_mb)
         except Exception as e:
             print(f"{YELLOW}❌ Error running command: {e}{RESET}")
+            status = "error"
+        results.append((clean_cmd, status))
+
+    return results
 
 
-def execute_microtask_output(paragraph: str):
+def execute_microtask_output(paragraph: str, **limits):
     """
     High-level function:
     - Extract commands from a microtask response
@@ -64,6 +291,53 @@ def execute_microtask_output(paragraph: str):
     commands = extract_commands(paragraph)
     if not commands:
         print("\n(No commands found — this microtask only describes an action.)\n")
-        return
+        return []
+
+    return run_commands(commands, **limits)
+
+
+def execute_plan(paragraphs: list, batch_installs: bool = True, snapshots=True, deadline=None, **limits):
+    """
+    Run the commands of a whole plan (one microtask paragraph per phase).
+    Package installs spread over several phases are merged first (see
+    install_batch.batch_install_commands). Returns one result list per phase.
+    Before each phase the working directory is snapshotted under the phase
+    number (snapshots: True, False or a WorkspaceSnapshots), and once more as
+    "end" after the last one, so a phase can be rolled back or diffed later.
+    A deadline is passed on to run_commands.
+    """
+    if snapshots is True:
+        snapshots = WorkspaceSnapshots()
+    if snapshots and not snapshots.safe:
+        print(f"{YELLOW}⚠ Not snapshotting {snapshots.root} (run from a project directory to enable rollback){RESET}")
+        snapshots = None
+
+    commands = [(i, cmd) for i, para in enumerate(paragraphs) for cmd in extract_commands(para or "")]
+    if batch_installs:
+        commands = batch_install_commands(commands)
 
-    run_commands(commands)
+    results = [[] for _ in paragraphs]
+    taken = False
+    try:
+        for i in range(len(paragraphs)):
+            phase_cmds = [cmd for idx, cmd in commands if idx == i]
+            if not phase_cmds:
+                continue
+            print(f"\n{YELLOW}=== Phase {i + 1} ==={RESET}")
+            if snapshots:
+                try:
+                    snap = snapshots.take(i + 1)
+                    taken = True
+                    print(f"{GREEN}✓ Snapshot taken ({snap['files']} files, {snap['copied']} copied, "
+                          f"{snap['seconds']:.2f}s){RESET}")
+                except OSError as e:
+                    print(f"{YELLOW}⚠ Snapshot failed: {e}{RESET}")
+            results[i] = run_commands(phase_cmds, deadline=deadline, **limits)
+    finally:
+        if taken:
+            # what the last phase changed, so rollback knows what the plan touched
+            try:
+                snapshots.take("end")
+            except OSError as e:
+                print(f"{YELLOW}⚠ Snapshot failed: {e}{RESET}")
+    return results
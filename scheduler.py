@@ -0,0 +1,406 @@
+# scheduler.py
+import os
+import time
+import threading
+import collections
+from contextlib import contextmanager
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Priority classes (lower value is served first)
+INTERACTIVE = 0    # user is waiting on it: detect_mode, clarifying questions, chat
+NORMAL = 1         # planning / microtask generation
+BACKGROUND = 2     # prefetch, batch runs
+SPECULATIVE = 3    # work that may be thrown away; preempted by interactive calls
+
+PRIORITY_NAMES = {
+    INTERACTIVE: "interactive",
+    NORMAL: "normal",
+    BACKGROUND: "background",
+    SPECULATIVE: "speculative",
+}
+
+# Number of parallel slots the model server has (llama.cpp --parallel etc.)
+DEFAULT_SLOTS = int(os.environ.get("E_ZERO_SLOTS", "2"))
+
+_local = threading.local()
+
+
+def set_session(session_id):
+    """Tag LLM calls made from the current thread with session_id (used for fair queuing)."""
+    _local.session = session_id
+
+
+def current_session():
+    return getattr(_local, "session", "default")
+
+
+class Cancelled(Exception):
+    """Raised when a request is cancelled (or preempted) before it got a slot."""
+
+
+class CancelScope:
+    """
+    Handle for a request made from another thread, usable before the request
+    is even queued: cancel() drops it, promote() makes speculative work
+    non-preemptible (and moves it up the queue if it has not started yet).
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.ticket = None
+        self.promoted_to = None
+
+    def cancel(self):
+        self.event.set()
+        if self.ticket is not None:
+            self.ticket.cancel()
+
+    @property
+    def cancelled(self):
+        return self.event.is_set()
+
+
+class Ticket:
+    """One scheduled request: its place in the queue, its slot and its response."""
+
+    def __init__(self, endpoint, priority, session, preemptible, slot=None):
+        self.endpoint = endpoint
+        self.priority = priority
+        self.session = session
+        self.preemptible = preemptible
+        self.pinned = slot is not None
+        self.slot = slot          # server slot (llama.cpp id_slot) the request runs in
+        self.enqueued_at = time.monotonic()
+        self.started_at = None
+        self.response = None
+        self.granted = False
+        self.released = False
+        self.cancelled = threading.Event()
+
+    @property
+    def queue_wait(self):
+        if self.started_at is None:
+            return time.monotonic() - self.enqueued_at
+        return self.started_at - self.enqueued_at
+
+    def cancel(self):
+        """Cancel the request. A running stream is closed so its reader stops."""
+        self.cancelled.set()
+        if self.response is not None:
+            try:
+                self.response.close()
+            except Exception:
+                pass
+
+    def iter_lines(self):
+        """iter_lines() of the response that stops quietly once the ticket is cancelled."""
+        try:
+            for raw in self.response.iter_lines():
+                if self.cancelled.is_set():
+                    return
+                yield raw
+        except Exception:
+            if self.cancelled.is_set():
+                return
+            raise
+
+
+class Scheduler:
+    """
+    Client-side scheduler for all LLM calls.
+
+    - priority classes: INTERACTIVE < NORMAL < BACKGROUND < SPECULATIVE
+    - per-endpoint concurrency limit matched to the server's slot count; every
+      request is sent to a concrete server slot (`id_slot`)
+    - reserved slots: reserve_slot() keeps a server slot for one owner (a
+      pinned chat conversation), other traffic never runs in it
+    - fair (round-robin) queuing between sessions inside a priority class
+    - preemption: an interactive request that finds no free slot cancels the
+      lowest priority preemptible request currently running
+    - queue-wait time recorded per priority class
+    """
+
+    def __init__(self, default_limit: int = DEFAULT_SLOTS, limits: dict = None):
+        self.default_limit = max(1, default_limit)
+        self.limits = dict(limits or {})
+        self._cond = threading.Condition()
+        # endpoint -> priority -> OrderedDict(session -> deque[Ticket])
+        self._queues = collections.defaultdict(lambda: collections.defaultdict(collections.OrderedDict))
+        self._running = collections.defaultdict(set)
+        self._reserved = collections.defaultdict(set)   # endpoint -> reserved server slots
+        self._closed_sessions = collections.OrderedDict()  # sessions whose requests are refused
+        self._waits = collections.defaultdict(lambda: collections.deque(maxlen=1000))
+        self.preemptions = 0
+
+        # one connection pool shared by every caller
+        self.http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max(10, self.default_limit * 4))
+        self.http.mount("http://", adapter)
+        self.http.mount("https://", adapter)
+
+    # ---- capacity -------------------------------------------------------
+
+    def set_limit(self, endpoint, limit: int):
+        with self._cond:
+            self.limits[endpoint] = max(1, limit)
+            self._dispatch(endpoint)
+
+    def limit(self, endpoint):
+        return self.limits.get(endpoint, self.default_limit)
+
+    def free_slots(self, endpoint):
+        """Idle slots available to unpinned requests (reserved slots are not counted)."""
+        with self._cond:
+            return len(self._free_indices(endpoint))
+
+    def reserve_slot(self, endpoint):
+        """
+        Reserve a server slot for pinned requests (acquire(..., slot=n)). Returns
+        the slot, or None when reserving it would leave no slot for other traffic.
+        """
+        with self._cond:
+            reserved = self._reserved[endpoint]
+            candidates = [i for i in range(self.limit(endpoint)) if i not in reserved]
+            if len(candidates) <= 1:
+                return None
+            busy = {t.slot for t in self._running[endpoint]}
+            # prefer a slot nothing is running in right now
+            slot = min(candidates, key=lambda i: (i in busy, i))
+            reserved.add(slot)
+            return slot
+
+    def release_slot(self, endpoint, slot):
+        if slot is None:
+            return
+        with self._cond:
+            self._reserved[endpoint].discard(slot)
+            self._dispatch(endpoint)
+
+    def slot_idle(self, endpoint, slot):
+        """True if the reserved slot has no request running in it."""
+        with self._cond:
+            return slot in self._reserved[endpoint] and all(t.slot != slot for t in self._running[endpoint])
+
+    def reserved_slots(self, endpoint):
+        with self._cond:
+            return set(self._reserved[endpoint])
+
+    def _free_indices(self, endpoint):
+        busy = {t.slot for t in self._running[endpoint]}
+        reserved = self._reserved[endpoint]
+        return [i for i in range(self.limit(endpoint)) if i not in busy and i not in reserved]
+
+    def queued(self, endpoint):
+        with self._cond:
+            return sum(len(q) for by_session in self._queues[endpoint].values() for q in by_session.values())
+
+    # ---- queueing -------------------------------------------------------
+
+    def acquire(self, endpoint, priority=NORMAL, session=None, preemptible=None, timeout=None, scope=None,
+                slot=None):
+        """
+        Block until a slot on endpoint is granted. Returns a Ticket.
+        With `slot` (from reserve_slot) the request waits for that server slot.
+        """
+        session = session if session is not None else current_session()
+        if preemptible is None:
+            preemptible = priority >= SPECULATIVE
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        with self._cond:
+            if session in self._closed_sessions:
+                raise Cancelled("session closed")
+            if scope is not None and scope.promoted_to is not None:
+                priority, preemptible = scope.promoted_to, False
+            if slot is not None and slot not in self._reserved[endpoint]:
+                slot = None   # released (or never reserved): run unpinned
+            ticket = Ticket(endpoint, priority, session, preemptible, slot)
+            if scope is not None:
+                # share the scope's event so cancel() works before and after queueing
+                ticket.cancelled = scope.event
+                scope.ticket = ticket
+            self._queues[endpoint][priority].setdefault(session, collections.deque()).append(ticket)
+            self._dispatch(endpoint)
+            if not ticket.granted and priority == INTERACTIVE:
+                self._preempt(ticket)
+
+            while not ticket.granted:
+                if ticket.cancelled.is_set():
+                    self._remove_queued(ticket)
+                    raise Cancelled("request cancelled while queued")
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    self._remove_queued(ticket)
+                    raise Cancelled("timed out waiting for a server slot")
+                # wake periodically so cancel() on a queued ticket is noticed
+                self._cond.wait(0.05 if remaining is None else min(0.05, remaining))
+
+            self._waits[ticket.priority].append(ticket.queue_wait)
+        return ticket
+
+    def release(self, ticket):
+        with self._cond:
+            if ticket.released:
+                return
+            ticket.released = True
+            self._running[ticket.endpoint].discard(ticket)
+            self._dispatch(ticket.endpoint)
+
+    def promote(self, scope, priority=INTERACTIVE):
+        """Turn speculative work into real work: no longer preemptible, served at `priority`."""
+        with self._cond:
+            scope.promoted_to = priority
+            ticket = scope.ticket
+            if ticket is None:
+                return
+            ticket.preemptible = False
+            if not ticket.granted and ticket.priority != priority:
+                self._remove_queued(ticket)
+                ticket.priority = priority
+                self._queues[ticket.endpoint][priority].setdefault(ticket.session, collections.deque()).append(ticket)
+                self._dispatch(ticket.endpoint)
+                if not ticket.granted and priority == INTERACTIVE:
+                    self._preempt(ticket)
+
+    def cancel_session(self, session):
+        """Cancel every queued and running request of session; later ones raise Cancelled."""
+        with self._cond:
+            self._closed_sessions[session] = True
+            while len(self._closed_sessions) > 1024:
+                self._closed_sessions.popitem(last=False)
+            for endpoint in list(self._running):
+                for ticket in list(self._running[endpoint]):
+                    if ticket.session == session:
+                        ticket.cancel()
+            for by_priority in self._queues.values():
+                for sessions in by_priority.values():
+                    for ticket in sessions.get(session, ()):
+                        ticket.cancel()
+            self._cond.notify_all()
+
+    def _runnable(self, ticket):
+        if ticket.pinned:
+            return all(t.slot != ticket.slot for t in self._running[ticket.endpoint])
+        return bool(self._free_indices(ticket.endpoint))
+
+    def _next_ticket(self, endpoint):
+        by_priority = self._queues[endpoint]
+        for priority in sorted(by_priority):
+            sessions = by_priority[priority]
+            for session, queue in list(sessions.items()):
+                while queue and queue[0].cancelled.is_set():
+                    queue.popleft()
+                if not queue:
+                    del sessions[session]
+                    continue
+                # a pinned request whose slot is busy doesn't hold up the others
+                if not self._runnable(queue[0]):
+                    continue
+                ticket = queue.popleft()
+                # rotate this session to the back so other sessions get the next turn
+                del sessions[session]
+                if queue:
+                    sessions[session] = queue
+                return ticket
+        return None
+
+    def _dispatch(self, endpoint):
+        running = self._running[endpoint]
+        while len(running) < self.limit(endpoint):
+            ticket = self._next_ticket(endpoint)
+            if ticket is None:
+                break
+            if not ticket.pinned:
+                ticket.slot = self._free_indices(endpoint)[0]
+            ticket.granted = True
+            ticket.started_at = time.monotonic()
+            running.add(ticket)
+        self._cond.notify_all()
+
+    def _remove_queued(self, ticket):
+        sessions = self._queues[ticket.endpoint][ticket.priority]
+        queue = sessions.get(ticket.session)
+        if queue and ticket in queue:
+            queue.remove(ticket)
+            if not queue:
+                del sessions[ticket.session]
+
+    def _preempt(self, ticket):
+        victims = [t for t in self._running[ticket.endpoint] if t.preemptible and not t.cancelled.is_set()]
+        if ticket.pinned:
+            # only whatever runs in the reserved slot is in the way
+            victims = [t for t in victims if t.slot == ticket.slot]
+        else:
+            victims = [t for t in victims if t.slot not in self._reserved[ticket.endpoint]]
+        if not victims:
+            return
+        # lowest priority first, then the most recently started
+        victim = max(victims, key=lambda t: (t.priority, t.started_at or 0))
+        self.preemptions += 1
+        victim.cancel()
+
+    # ---- requests -------------------------------------------------------
+
+    @contextmanager
+    def stream(self, url, payload, priority=NORMAL, session=None, preemptible=None, timeout=None, headers=None,
+               scope=None, queue_timeout=None, slot=None):
+        """
+        Streaming POST through the scheduler. Yields the Ticket; iterate
+        ticket.iter_lines(). The slot is held until the block exits.
+        Pass a CancelScope to be able to cancel/promote it from another thread.
+        queue_timeout bounds the wait for a slot (Cancelled is raised after it).
+        slot is a reserved server slot (see reserve_slot) the request is pinned to.
+        """
+        ticket = self.acquire(url, priority, session, preemptible, timeout=queue_timeout, scope=scope, slot=slot)
+        try:
+            ticket.response = self.http.post(
+                url, json=dict(payload, id_slot=ticket.slot), headers=headers or {"Content-Type": "application/json"},
+                stream=True, timeout=timeout,
+            )
+            if ticket.cancelled.is_set():
+                ticket.response.close()
+            yield ticket
+        finally:
+            if ticket.response is not None:
+                ticket.response.close()
+            self.release(ticket)
+
+    def post(self, url, payload, priority=NORMAL, session=None, timeout=None, headers=None, endpoint=None,
+             queue_timeout=None, slot=None):
+        """
+        Non-streaming POST through the scheduler. Returns the requests.Response.
+        `endpoint` names the slot pool to use when it differs from url (same server, other route).
+        """
+        ticket = self.acquire(endpoint or url, priority, session, preemptible=False, timeout=queue_timeout, slot=slot)
+        try:
+            ticket.response = self.http.post(
+                url, json=dict(payload, id_slot=ticket.slot), headers=headers or {"Content-Type": "application/json"},
+                timeout=timeout,
+            )
+            return ticket.response
+        finally:
+            self.release(ticket)
+
+    # ---- metrics --------------------------------------------------------
+
+    def queue_wait_stats(self):
+        """Queue-wait time (seconds) per priority class: count, mean, p50, p95, max."""
+        with self._cond:
+            snapshot = {p: sorted(w) for p, w in self._waits.items() if w}
+        out = {}
+        for priority, waits in snapshot.items():
+            n = len(waits)
+            out[PRIORITY_NAMES.get(priority, str(priority))] = {
+                "count": n,
+                "mean": sum(waits) / n,
+                "p50": waits[n // 2],
+                "p95": waits[min(n - 1, int(n * 0.95))],
+                "max": waits[-1],
+            }
+        return out
+
+
+# Shared scheduler used by every module
+SCHEDULER = Scheduler()
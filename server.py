@@ -0,0 +1,330 @@
+# server.py
+"""
+Multi-session server mode.
+
+Runs the same pipeline as main.py, but for many users at once. Every session
+shares this process's connection pool, plan index and scheduler.
+
+HTTP API (JSON bodies, events as Server-Sent Events):
+  POST   /sessions                   {"user": "..."} (optional; enables remembered answers) -> {"session_id": ...}
+  GET    /sessions/<id>/events       -> SSE stream: mode, token, question (with question_id),
+                                        refined_goal, phases, phase_start, done, error
+  POST   /sessions/<id>/messages     {"message": "...", "deadline": 60}  start a chat/phase turn
+                                        (deadline: optional overall seconds for a phase-mode turn)
+  POST   /sessions/<id>/answer       {"question_id": "...", "answer": "..."}   answer that question
+  DELETE /sessions/<id>                stops the session's running turn
+  GET    /stats                      -> sessions, scheduler queue-wait, micro-batching and stage budget metrics
+
+Run: python server.py [--host 127.0.0.1] [--port 8080]
+"""
+import json
+import uuid
+import time
+import queue
+import asyncio
+import argparse
+import concurrent.futures
+
+import mode_detector
+
+from scheduler import SCHEDULER, Cancelled, set_session
+from mode_detector import detect_mode, enable_batching, PHRASE_REGEX
+from goal_refine import refine_goal_interactive
+from budgets import BUDGETS
+from deadline import Deadline
+from preferences import PreferenceStore
+from micro_tasks import generate_microtasks_for_phases
+from main import API_URL, stream_chat, plan_phases, Speculation
+from chat_history import Conversation
+
+ANSWER_TIMEOUT = 600      # seconds a question waits for its answer
+SESSION_TTL = 1800        # idle sessions are dropped after this many seconds
+MAX_WORKERS = 64          # pipeline threads shared by all sessions
+KEEPALIVE = 15            # seconds between SSE keep-alive comments
+EXPIRE_EVERY = 60         # seconds between idle-session sweeps
+
+_CLOSED = object()        # put on a session's answer queue to unblock ask() when it is closed
+
+
+class Session:
+    def __init__(self, loop, preferences=None):
+        self.id = uuid.uuid4().hex[:12]
+        self.loop = loop
+        self.preferences = preferences
+        self.events = asyncio.Queue()
+        self.answers = queue.Queue()
+        self.conversation = Conversation()
+        self.busy = False
+        self.closed = False
+        self.last_active = time.monotonic()
+
+    def emit(self, event, data):
+        """Thread-safe: queue an event for the SSE stream."""
+        self.loop.call_soon_threadsafe(self.events.put_nowait, (event, data))
+
+    def ask(self, q):
+        """
+        Pipeline-side answer source: publish the question and block until it is
+        answered. Answers carry the question_id they answer; late or duplicate
+        answers to earlier questions are dropped. Raises Cancelled once the
+        session is closed.
+        """
+        question_id = uuid.uuid4().hex[:8]
+        self.emit("question", {"question_id": question_id, "question": q["question"], "type": q["type"],
+                               "choices": q["choices"]})
+        give_up = time.monotonic() + ANSWER_TIMEOUT
+        while True:
+            try:
+                answered, answer = self.answers.get(timeout=max(0, give_up - time.monotonic()))
+            except queue.Empty:
+                return ""
+            if answer is _CLOSED:
+                raise Cancelled("session closed")
+            if answered == question_id:
+                return str(answer).strip()
+
+    def close(self):
+        """Stop the session: cancel its model requests, unblock a pending question, free its chat slot."""
+        if self.closed:
+            return
+        self.closed = True
+        SCHEDULER.cancel_session(self.id)
+        self.answers.put((None, _CLOSED))
+        self.conversation.close()
+
+    def run_turn(self, message, deadline_seconds=None):
+        """Runs in a worker thread: one user message through chat or phase mode."""
+        set_session(self.id)
+        deadline = Deadline.after(deadline_seconds)
+        try:
+            speculation = None if PHRASE_REGEX.search(message) else Speculation(message, self.conversation,
+                                                                                  self.preferences)
+            mode = detect_mode(message)
+            if speculation:
+                speculation.resolve(mode)
+            self.emit("mode", {"mode": mode})
+            if mode == "phase":
+                q_text = speculation.questions() if speculation else None
+                result = refine_goal_interactive(message, ask=self.ask, q_text=q_text, deadline=deadline,
+                                                 preferences=self.preferences,
+                                                 known=speculation.known if speculation else None)
+                refined_goal = result["refined_goal_paragraph"]
+                self.emit("refined_goal", {"refined_goal": refined_goal})
+
+                phases = plan_phases(refined_goal, ask=self.ask, deadline=deadline)
+                self.emit("phases", {"phases": phases})
+
+                started = set()
+
+                def on_token(phase, token):
+                    if phase not in started:
+                        started.add(phase)
+                        self.emit("phase_start", {"phase": phase})
+                    self.emit("token", {"phase": phase, "token": token})
+
+                paragraphs = generate_microtasks_for_phases(refined_goal, phases, delay_between=0, on_token=on_token,
+                                                            deadline=deadline)
+                # fewer microtasks than phases: the deadline stopped planning early
+                self.emit("done", {"mode": mode, "microtasks": paragraphs, "partial": len(paragraphs) < len(phases)})
+            else:
+                tokens = speculation.chat() if speculation else None
+                if tokens is None:
+                    text = stream_chat(message, on_token=lambda token: self.emit("token", {"token": token}),
+                                       conversation=self.conversation)
+                else:
+                    text = ""
+                    for token in tokens:
+                        text += token
+                        self.emit("token", {"token": token})
+                self.emit("done", {"mode": mode, "response": text})
+        except Exception as e:
+            self.emit("error", {"error": str(e)})
+        finally:
+            self.busy = False
+            self.last_active = time.monotonic()
+
+
+class PipelineServer:
+    def __init__(self, host="127.0.0.1", port=8080):
+        self.host = host
+        self.port = port
+        self.sessions = {}
+        self.preferences = {}     # user -> PreferenceStore, shared by that user's sessions
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS)
+
+    # ---- HTTP plumbing --------------------------------------------------
+
+    async def _read_request(self, reader):
+        head = await reader.readuntil(b"\r\n\r\n")
+        lines = head.decode("latin-1").split("\r\n")
+        method, path, _ = lines[0].split(" ", 2)
+        headers = {}
+        for line in lines[1:]:
+            if ":" in line:
+                k, v = line.split(":", 1)
+                headers[k.strip().lower()] = v.strip()
+        body = b""
+        length = int(headers.get("content-length", "0") or 0)
+        if length:
+            body = await reader.readexactly(length)
+        return method.upper(), path.split("?", 1)[0], headers, body
+
+    async def _send_json(self, writer, status, obj):
+        payload = json.dumps(obj).encode("utf-8")
+        reason = {200: "OK", 201: "Created", 202: "Accepted", 400: "Bad Request",
+                  404: "Not Found", 409: "Conflict", 500: "Internal Server Error"}.get(status, "OK")
+        writer.write(
+            f"HTTP/1.1 {status} {reason}\r\n"
+            f"Content-Type: application/json\r\n"
+            f"Content-Length: {len(payload)}\r\n"
+            f"Connection: keep-alive\r\n\r\n".encode("latin-1") + payload
+        )
+        await writer.drain()
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    method, path, headers, body = await self._read_request(reader)
+                except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+                    break
+                parts = [p for p in path.split("/") if p]
+                if method == "GET" and len(parts) == 3 and parts[0] == "sessions" and parts[2] == "events":
+                    # SSE takes over the connection until the client goes away
+                    await self._stream_events(writer, parts[1])
+                    break
+                try:
+                    status, obj = self._route(method, parts, body)
+                except Exception as e:
+                    status, obj = 500, {"error": str(e)}
+                await self._send_json(writer, status, obj)
+                if headers.get("connection", "").lower() == "close":
+                    break
+        finally:
+            writer.close()
+
+    def _route(self, method, parts, body):
+        data = json.loads(body.decode("utf-8")) if body else {}
+
+        if parts == ["stats"] and method == "GET":
+            return 200, {
+                "sessions": len(self.sessions),
+                "busy_sessions": sum(1 for s in self.sessions.values() if s.busy),
+                "queued_requests": SCHEDULER.queued(API_URL),
+                "free_slots": SCHEDULER.free_slots(API_URL),
+                "queue_wait": SCHEDULER.queue_wait_stats(),
+                "preemptions": SCHEDULER.preemptions,
+                "mode_batches": mode_detector.MODE_BATCHER.batches if mode_detector.MODE_BATCHER else 0,
+                "mode_batch_mean_size": mode_detector.MODE_BATCHER.mean_batch_size if mode_detector.MODE_BATCHER else 0,
+                "stage_budgets": BUDGETS.report(),
+            }
+
+        if parts == ["sessions"] and method == "POST":
+            self._expire_sessions()
+            user = str(data.get("user") or "").strip()
+            preferences = None
+            if user:
+                if user not in self.preferences:
+                    self.preferences[user] = PreferenceStore(user)
+                preferences = self.preferences[user]
+            session = Session(asyncio.get_running_loop(), preferences)
+            self.sessions[session.id] = session
+            return 201, {"session_id": session.id}
+
+        if len(parts) < 2 or parts[0] != "sessions":
+            return 404, {"error": "not found"}
+        session = self.sessions.get(parts[1])
+        if session is None:
+            return 404, {"error": "unknown session"}
+        session.last_active = time.monotonic()
+
+        if len(parts) == 2 and method == "DELETE":
+            del self.sessions[session.id]
+            session.close()
+            return 200, {"deleted": session.id}
+
+        if parts[2:] == ["messages"] and method == "POST":
+            message = str(data.get("message", "")).strip()
+            if not message:
+                return 400, {"error": "message is required"}
+            try:
+                deadline_seconds = float(data.get("deadline") or 0) or None
+            except (TypeError, ValueError):
+                return 400, {"error": "deadline must be a number of seconds"}
+            if session.busy:
+                return 409, {"error": "session is busy with a previous message"}
+            session.busy = True
+            self.executor.submit(session.run_turn, message, deadline_seconds)
+            return 202, {"accepted": True}
+
+        if parts[2:] == ["answer"] and method == "POST":
+            question_id = data.get("question_id")
+            if not question_id:
+                return 400, {"error": "question_id is required"}
+            session.answers.put((str(question_id), data.get("answer", "")))
+            return 200, {"accepted": True}
+
+        return 404, {"error": "not found"}
+
+    async def _stream_events(self, writer, session_id):
+        session = self.sessions.get(session_id)
+        if session is None:
+            await self._send_json(writer, 404, {"error": "unknown session"})
+            return
+        writer.write(
+            b"HTTP/1.1 200 OK\r\n"
+            b"Content-Type: text/event-stream\r\n"
+            b"Cache-Control: no-cache\r\n"
+            b"Connection: keep-alive\r\n\r\n"
+        )
+        await writer.drain()
+        try:
+            while True:
+                try:
+                    event, data = await asyncio.wait_for(session.events.get(), timeout=KEEPALIVE)
+                except asyncio.TimeoutError:
+                    writer.write(b": keep-alive\n\n")
+                else:
+                    writer.write(f"event: {event}\ndata: {json.dumps(data)}\n\n".encode("utf-8"))
+                await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+
+    def _expire_sessions(self):
+        now = time.monotonic()
+        for sid, s in list(self.sessions.items()):
+            if not s.busy and now - s.last_active > SESSION_TTL:
+                del self.sessions[sid]
+                s.close()
+
+    async def _expire_periodically(self):
+        while True:
+            await asyncio.sleep(EXPIRE_EVERY)
+            self._expire_sessions()
+
+    async def serve(self):
+        server = await asyncio.start_server(self._handle, self.host, self.port)
+        print(f"Serving pipeline sessions on http://{self.host}:{self.port}")
+        expiry = asyncio.get_running_loop().create_task(self._expire_periodically())
+        async with server:
+            try:
+                await server.serve_forever()
+            finally:
+                expiry.cancel()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve chat/phase mode sessions over HTTP + SSE.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--batch-window-ms", type=float, default=0,
+                        help="micro-batch detect_mode calls across sessions for up to this many ms (0 = off)")
+    parser.add_argument("--batch-strategy", choices=["prompt", "endpoint"], default="prompt",
+                        help="prompt: one multi-item prompt; endpoint: one multi-prompt /v1/completions request")
+    args = parser.parse_args()
+    if args.batch_window_ms > 0:
+        enable_batching(max_wait_ms=args.batch_window_ms, strategy=args.batch_strategy)
+    try:
+        asyncio.run(PipelineServer(args.host, args.port).serve())
+    except KeyboardInterrupt:
+        pass
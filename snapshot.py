@@ -0,0 +1,411 @@
+# snapshot.py
+import os
+import json
+import time
+import shutil
+import difflib
+import hashlib
+
+from plan_cache import CACHE_DIR
+
+SNAPSHOT_ROOT = os.path.join(CACHE_DIR, "snapshots")
+
+# Directory names never snapshotted or touched by rollback: our own state, caches,
+# version control and installed dependencies (reinstalled by the plan's commands)
+DEFAULT_EXCLUDE = {
+    ".e_zero", "__pycache__", ".pytest_cache", ".mypy_cache", ".ruff_cache", ".tox", ".nox",
+    ".git", ".hg", ".svn",
+    "node_modules", ".venv", "venv", "site-packages", ".next", ".parcel-cache",
+}
+
+# Snapshots kept per workspace (oldest are pruned)
+DEFAULT_KEEP = 12
+
+# Linux FICLONE ioctl: share extents with the source file (btrfs, XFS, bcachefs, ...)
+FICLONE = 0x40049409
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+
+def _reflink(src: str, dst: str):
+    """Clone src to dst sharing data blocks. Raises OSError if the filesystem can't."""
+    if fcntl is None:
+        raise OSError("reflink not supported")
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            fdst.close()
+            os.unlink(dst)
+            raise
+
+
+class WorkspaceSnapshots:
+    """
+    Snapshots of a working directory, taken before each phase's commands run.
+
+    Each snapshot is a manifest (path -> size, mtime, mode). File contents
+    live in a shared object store keyed by (path, size, mtime), so a file
+    (or a whole subtree) unchanged since the previous snapshot costs no
+    write at all, not even a link: the new manifest just names the same
+    objects. Only new or changed files are copied, by reflink where the
+    filesystem supports it, by plain copy otherwise. Taking a snapshot
+    therefore costs one stat per file plus the data that actually changed;
+    VCS and dependency directories (DEFAULT_EXCLUDE) aren't walked at all.
+    Objects are never modified, and deleted once no kept snapshot names them.
+
+    rollback(label) only undoes what changed between snapshot `label` and
+    the later snapshots (execute_plan takes a final "end" one), so files the
+    plan's commands never touched survive. / and the home directory are
+    refused as roots.
+    """
+
+    def __init__(self, root: str = None, store: str = None, keep: int = DEFAULT_KEEP, exclude=None):
+        self.root = os.path.realpath(root or os.getcwd())
+        key = hashlib.sha1(self.root.encode("utf-8")).hexdigest()[:12]
+        self.store = store or os.path.join(SNAPSHOT_ROOT, key)
+        self.keep = max(1, keep)
+        self.exclude = set(DEFAULT_EXCLUDE if exclude is None else exclude)
+        self._reflink_ok = None   # learned on first copy
+
+    # ---- index ----------------------------------------------------------
+
+    def _index_path(self):
+        return os.path.join(self.store, "index.json")
+
+    def _load_index(self):
+        try:
+            with open(self._index_path(), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {"next_id": 1, "snapshots": []}
+
+    def _save_index(self, index):
+        os.makedirs(self.store, exist_ok=True)
+        tmp = self._index_path() + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(index, f, indent=1)
+        os.replace(tmp, self._index_path())
+
+    def _dir(self, snap_id):
+        return os.path.join(self.store, str(snap_id))
+
+    def _object(self, rel, meta):
+        key = hashlib.sha1(f"{rel}\0{meta[0]}\0{meta[1]}".encode("utf-8")).hexdigest()
+        return os.path.join(self.store, "objects", key[:2], key[2:])
+
+    def _source(self, snap_id, manifest, rel):
+        """Where the content of rel in a snapshot is stored."""
+        if manifest.get("format", 1) >= 2:
+            return self._object(rel, manifest["files"][rel])
+        # snapshots taken before the object store kept their own file tree
+        return os.path.join(self._dir(snap_id), "files", rel)
+
+    def _manifest(self, snap_id):
+        try:
+            with open(os.path.join(self._dir(snap_id), "manifest.json"), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def labels(self):
+        """Snapshot entries, oldest first: dicts with id, label, created, files, copied."""
+        return self._load_index()["snapshots"]
+
+    def _find(self, label):
+        snaps = self.labels()
+        for pos in range(len(snaps) - 1, -1, -1):
+            if snaps[pos]["label"] == str(label):
+                return snaps, pos
+        raise KeyError(f"no snapshot named {label!r}")
+
+    # ---- file helpers ---------------------------------------------------
+
+    def _copy(self, src, dst):
+        """Copy src to dst: reflink if possible, else a plain copy. Returns bytes written."""
+        if self._reflink_ok is not False:
+            try:
+                _reflink(src, dst)
+                self._reflink_ok = True
+                shutil.copystat(src, dst)
+                return 0
+            except OSError:
+                self._reflink_ok = False
+        shutil.copy2(src, dst)
+        return os.path.getsize(dst)
+
+    def scan(self):
+        """Current state of the tree: {"files": {rel: [size, mtime_ns, mode]}, "links": {rel: target}, "dirs": [rel]}."""
+        files, links, dirs = {}, {}, []
+        store = os.path.realpath(self.store)
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames[:] = [d for d in dirnames
+                           if d not in self.exclude and os.path.realpath(os.path.join(dirpath, d)) != store]
+            rel_dir = os.path.relpath(dirpath, self.root)
+            for d in dirnames:
+                path = os.path.join(dirpath, d)
+                rel = os.path.normpath(os.path.join(rel_dir, d))
+                if os.path.islink(path):
+                    # os.walk doesn't descend into symlinked dirs; record the link itself
+                    links[rel] = os.readlink(path)
+                else:
+                    dirs.append(rel)
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                rel = os.path.normpath(os.path.join(rel_dir, name))
+                try:
+                    st = os.lstat(path)
+                except OSError:
+                    continue
+                if os.path.islink(path):
+                    links[rel] = os.readlink(path)
+                elif os.path.isfile(path):
+                    files[rel] = [st.st_size, st.st_mtime_ns, st.st_mode & 0o7777]
+        return {"files": files, "links": links, "dirs": dirs}
+
+    # ---- snapshot / rollback / diff -----------------------------------
+
+    def take(self, label):
+        """
+        Snapshot the tree under `label` (e.g. the phase number). A newer
+        snapshot with the same label hides the older one.
+        Returns the index entry (files, copied, reused, bytes, seconds);
+        bytes counts plain copies only, reflinked files share their blocks.
+        """
+        self._check_root()
+        start = time.monotonic()
+        index = self._load_index()
+        snap_id = index["next_id"]
+        prev = self._manifest(index["snapshots"][-1]["id"]) if index["snapshots"] else None
+        prev_files = prev["files"] if prev and prev.get("format", 1) >= 2 else {}
+
+        os.makedirs(self._dir(snap_id), exist_ok=True)
+        state = self.scan()
+        state["format"] = 2
+
+        copied = reused = written = 0
+        for rel, meta in list(state["files"].items()):
+            old = prev_files.get(rel)
+            if old and old[:2] == meta[:2]:
+                reused += 1
+                continue
+            dst = self._object(rel, meta)
+            if os.path.exists(dst):
+                # same path, size and mtime as in an older snapshot
+                reused += 1
+                continue
+            try:
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                written += self._copy(os.path.join(self.root, rel), dst + ".tmp")
+                os.replace(dst + ".tmp", dst)
+                copied += 1
+            except OSError:
+                # vanished or unreadable while we were walking
+                del state["files"][rel]
+
+        with open(os.path.join(self._dir(snap_id), "manifest.json"), "w", encoding="utf-8") as f:
+            json.dump(state, f)
+
+        entry = {
+            "id": snap_id,
+            "label": str(label),
+            "created": time.time(),
+            "files": len(state["files"]),
+            "copied": copied,
+            "reused": reused,
+            "bytes": written,
+            "seconds": round(time.monotonic() - start, 3),
+        }
+        index["next_id"] = snap_id + 1
+        index["snapshots"].append(entry)
+        self._prune(index)
+        self._save_index(index)
+        return entry
+
+    def _prune(self, index):
+        pruned = []
+        while len(index["snapshots"]) > self.keep:
+            pruned.append(index["snapshots"].pop(0))
+        if not pruned:
+            return
+        kept = set()
+        for snap in index["snapshots"]:
+            manifest = self._manifest(snap["id"]) or {}
+            if manifest.get("format", 1) >= 2:
+                kept.update(self._object(rel, meta) for rel, meta in manifest["files"].items())
+        for snap in pruned:
+            manifest = self._manifest(snap["id"]) or {}
+            if manifest.get("format", 1) >= 2:
+                for rel, meta in manifest["files"].items():
+                    path = self._object(rel, meta)
+                    if path not in kept:
+                        try:
+                            os.unlink(path)
+                        except OSError:
+                            pass
+            shutil.rmtree(self._dir(snap["id"]), ignore_errors=True)
+
+    def _check_root(self):
+        if self.root in _unsafe_roots():
+            raise ValueError(f"refusing to snapshot or roll back {self.root}; run from a project directory")
+
+    @property
+    def safe(self):
+        """False for roots that are never snapshotted (/ and the home directory)."""
+        return self.root not in _unsafe_roots()
+
+    @staticmethod
+    def _changes(a, b):
+        """(paths, dirs) that differ between manifests a and b; paths are files and links."""
+        paths = {rel for rel in set(a["files"]) | set(b["files"])
+                 if (a["files"].get(rel) or [None, None])[:2] != (b["files"].get(rel) or [None, None])[:2]}
+        paths |= {rel for rel in set(a["links"]) | set(b["links"]) if a["links"].get(rel) != b["links"].get(rel)}
+        return paths, set(a["dirs"]) ^ set(b["dirs"])
+
+    def rollback(self, label):
+        """
+        Undo what changed after snapshot `label`. Only paths that differ
+        between it and the later snapshots (i.e. what the plan's commands
+        created, changed or deleted) are touched; files that appeared or
+        changed outside those windows are left alone. If `label` is the
+        latest snapshot, the current tree is snapshotted first and counts
+        as the result of that phase. Returns counts: restored, deleted.
+        """
+        self._check_root()
+        snaps, pos = self._find(label)
+        if pos == len(snaps) - 1:
+            snap_id = snaps[pos]["id"]
+            self.take("end")
+            snaps = self.labels()
+            pos = next(i for i, s in enumerate(snaps) if s["id"] == snap_id)
+        manifests = [self._manifest(s["id"]) for s in snaps[pos:]]
+        if any(m is None for m in manifests):
+            raise KeyError(f"snapshot {label!r} or a later one is missing its manifest")
+        snap_id, manifest = snaps[pos]["id"], manifests[0]
+
+        paths, dirs = set(), set()
+        for a, b in zip(manifests, manifests[1:]):
+            p, d = self._changes(a, b)
+            paths |= p
+            dirs |= d
+        keep = set(manifest["files"]) | set(manifest["links"])
+        restored = deleted = 0
+
+        # remove what the plan created
+        for rel in sorted(paths - keep):
+            path = os.path.join(self.root, rel)
+            if os.path.islink(path) or os.path.isfile(path):
+                os.unlink(path)
+                deleted += 1
+        for rel in sorted(dirs - set(manifest["dirs"]), key=len, reverse=True):
+            path = os.path.join(self.root, rel)
+            if rel in keep:
+                shutil.rmtree(path, ignore_errors=True)   # a directory made where the snapshot has a file
+            else:
+                try:
+                    os.rmdir(path)
+                except OSError:
+                    pass   # still holds files the plan didn't create
+
+        for rel in sorted(dirs & set(manifest["dirs"])):
+            os.makedirs(os.path.join(self.root, rel), exist_ok=True)
+
+        # restore what it changed or deleted
+        for rel in sorted(paths & set(manifest["files"])):
+            meta = manifest["files"][rel]
+            dst = os.path.join(self.root, rel)
+            try:
+                st = os.lstat(dst)
+                now = [st.st_size, st.st_mtime_ns] if os.path.isfile(dst) and not os.path.islink(dst) else None
+            except OSError:
+                now = None
+            if now == meta[:2]:
+                continue
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            if os.path.isdir(dst) and not os.path.islink(dst):
+                shutil.rmtree(dst)
+            elif os.path.lexists(dst):
+                os.unlink(dst)
+            # never hardlink into the workspace: an in-place edit would change the snapshot too
+            self._copy(self._source(snap_id, manifest, rel), dst)
+            os.chmod(dst, meta[2])
+            os.utime(dst, ns=(meta[1], meta[1]))
+            restored += 1
+
+        for rel in sorted(paths & set(manifest["links"])):
+            target = manifest["links"][rel]
+            path = os.path.join(self.root, rel)
+            if os.path.islink(path) and os.readlink(path) == target:
+                continue
+            if os.path.lexists(path) and not os.path.isdir(path):
+                os.unlink(path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.symlink(target, path)
+            restored += 1
+
+        return {"restored": restored, "deleted": deleted}
+
+    def diff(self, label, max_lines: int = 200):
+        """
+        What changed between snapshot `label` and the state after it (the next
+        snapshot, or the current tree if it is the latest).
+        Returns {"added": [...], "removed": [...], "modified": [...], "patch": str}.
+        """
+        snaps, pos = self._find(label)
+        before_id = snaps[pos]["id"]
+        before = self._manifest(before_id)
+        if pos + 1 < len(snaps):
+            after_id = snaps[pos + 1]["id"]
+            after = self._manifest(after_id)
+            after_path = lambda rel: self._source(after_id, after, rel)
+        else:
+            after = self.scan()
+            after_path = lambda rel: os.path.join(self.root, rel)
+        before_path = lambda rel: self._source(before_id, before, rel)
+
+        b_paths = set(before["files"]) | set(before["links"])
+        a_paths = set(after["files"]) | set(after["links"])
+        modified = sorted(
+            rel for rel in b_paths & a_paths
+            if before["files"].get(rel, [None, None])[:2] != after["files"].get(rel, [None, None])[:2]
+            or before["links"].get(rel) != after["links"].get(rel)
+        )
+
+        patch = []
+        for rel in modified:
+            if len(patch) >= max_lines:
+                break
+            old = _read_text(before_path(rel)) if rel in before["files"] else None
+            new = _read_text(after_path(rel)) if rel in after["files"] else None
+            if old is None or new is None:
+                patch.append(f"Binary or large file {rel} differs\n")
+                continue
+            patch.extend(difflib.unified_diff(old, new, fromfile=f"a/{rel}", tofile=f"b/{rel}"))
+
+        return {
+            "added": sorted(a_paths - b_paths),
+            "removed": sorted(b_paths - a_paths),
+            "modified": modified,
+            "patch": "".join(patch[:max_lines]),
+        }
+
+
+def _unsafe_roots():
+    return {os.path.realpath(os.sep), os.path.realpath(os.path.expanduser("~"))}
+
+
+def _read_text(path: str, limit: int = 1024 * 1024):
+    """Lines of a text file, or None for binary/oversized/unreadable files."""
+    try:
+        if os.path.getsize(path) > limit:
+            return None
+        with open(path, "rb") as f:
+            data = f.read()
+    except OSError:
+        return None
+    if b"\0" in data[:8192]:
+        return None
+    return data.decode("utf-8", errors="replace").splitlines(keepends=True)
@@ -0,0 +1,79 @@
+import install_batch
+from install_batch import batch_install_commands, parse_install
+
+
+def _plain(commands):
+    return batch_install_commands(commands, use_cache=False)
+
+
+def test_same_flags_merge_into_first_install():
+    out = _plain([(0, "pip install flask"), (1, "echo hi"), (2, "pip install requests")])
+    assert out == [(0, "pip install flask requests"), (1, "echo hi")]
+
+
+def test_other_flags_close_open_groups():
+    out = _plain([(0, "pip install flask"), (1, "pip install --upgrade pip"), (2, "pip install numpy")])
+    assert out == [(0, "pip install flask"), (1, "pip install --upgrade pip"), (2, "pip install numpy")]
+
+
+def test_unparsed_command_of_same_manager_closes_group():
+    out = _plain([(0, "pip install flask"), (1, "pip install -r requirements.txt"), (2, "pip install numpy")])
+    assert out == [(0, "pip install flask"), (1, "pip install -r requirements.txt"), (2, "pip install numpy")]
+
+
+def test_other_manager_does_not_close_group():
+    out = _plain([(0, "pip install flask"), (1, "npm install express"), (2, "pip install numpy")])
+    assert out == [(0, "pip install flask numpy"), (1, "npm install express")]
+
+
+def test_env_change_closes_every_group():
+    out = _plain([(0, "pip install flask"), (1, "python -m venv .venv"), (2, "pip install numpy")])
+    assert out == [(0, "pip install flask"), (1, "python -m venv .venv"), (2, "pip install numpy")]
+
+
+def test_conflicting_version_keeps_order():
+    out = _plain([(0, "pip install flask==2.0"), (1, "pip install flask==3.0")])
+    assert out == [(0, "pip install flask==2.0"), (1, "pip install flask==3.0")]
+
+
+def test_duplicate_package_is_installed_once():
+    out = _plain([(0, "pip install flask"), (1, "pip install flask requests")])
+    assert out == [(0, "pip install flask requests")]
+
+
+def test_parse_install_rejects_paths_and_unknown_flags():
+    assert parse_install("pip install ./pkg") is None
+    assert parse_install("pip install -e .") is None
+    assert parse_install("npm install") is None
+    assert parse_install("python3 -m pip install -q rich")["packages"] == ["rich"]
+
+
+def test_cached_pip_builds_wheels_then_installs_offline(monkeypatch):
+    monkeypatch.setattr(install_batch, "WHEELHOUSE", "/wh")
+    out = batch_install_commands([(0, "pip install --pre flask"), (1, "pip install --pre numpy")])
+    assert out == [
+        (0, "pip wheel --wheel-dir /wh --pre flask numpy"),
+        (0, "pip install --pre --no-index --find-links /wh flask numpy"),
+    ]
+
+
+def test_pinned_requirements_in_wheelhouse_skip_pip_wheel(monkeypatch, tmp_path):
+    monkeypatch.setattr(install_batch, "WHEELHOUSE", str(tmp_path))
+    (tmp_path / "Flask-2.0.1-py3-none-any.whl").write_bytes(b"")
+    (tmp_path / "numpy-1.26.4-cp311-cp311-manylinux_2_17_x86_64.whl").write_bytes(b"")
+    out = batch_install_commands([(0, "pip install flask==2.0.1 numpy==1.26.4")])
+    assert out == [(0, f"pip install --no-index --find-links {tmp_path} flask==2.0.1 numpy==1.26.4")]
+
+    # an unpinned or missing requirement still resolves against the index first
+    for cmd in ("pip install flask numpy==1.26.4", "pip install flask==3.0 numpy==1.26.4"):
+        out = batch_install_commands([(0, cmd)])
+        assert out[0][1].startswith("pip wheel ")
+
+
+def test_cached_npm_prefers_offline():
+    out = batch_install_commands([(0, "npm install express"), (2, "npm i -D jest"), (3, "npm install cors")])
+    assert out == [
+        (0, "npm install --prefer-offline express"),
+        (2, "npm install -D --prefer-offline jest"),
+        (3, "npm install --prefer-offline cors"),
+    ]
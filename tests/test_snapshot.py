@@ -0,0 +1,161 @@
+import os
+
+import pytest
+
+from snapshot import WorkspaceSnapshots
+
+
+def _write(path, text):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text)
+
+
+def _read(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read()
+
+
+@pytest.fixture
+def tree(tmp_path):
+    root = tmp_path / "work"
+    _write(str(root / "app.py"), "print('v1')\n")
+    _write(str(root / "pkg" / "util.py"), "X = 1\n")
+    _write(str(root / "README.md"), "readme\n")
+    _write(str(root / "__pycache__" / "app.pyc"), "cache")
+    snaps = WorkspaceSnapshots(str(root), store=str(tmp_path / "store"))
+    return root, snaps
+
+
+def test_take_reuses_unchanged_files(tree):
+    root, snaps = tree
+    first = snaps.take(1)
+    assert (first["files"], first["copied"], first["reused"]) == (3, 3, 0)
+
+    _write(str(root / "app.py"), "print('v2 changed')\n")
+    second = snaps.take(2)
+    assert (second["files"], second["copied"], second["reused"]) == (3, 1, 2)
+    assert [s["label"] for s in snaps.labels()] == ["1", "2"]
+
+
+def test_rollback_restores_modified_deleted_and_added(tree):
+    root, snaps = tree
+    snaps.take(1)
+
+    _write(str(root / "app.py"), "print('broken')\n")
+    os.unlink(str(root / "README.md"))
+    _write(str(root / "new" / "extra.py"), "extra\n")
+    os.symlink("app.py", str(root / "link.py"))
+
+    counts = snaps.rollback(1)
+    assert counts == {"restored": 2, "deleted": 2}
+    assert _read(str(root / "app.py")) == "print('v1')\n"
+    assert _read(str(root / "README.md")) == "readme\n"
+    assert not os.path.exists(str(root / "new"))
+    assert not os.path.lexists(str(root / "link.py"))
+    # excluded directories are left alone
+    assert os.path.exists(str(root / "__pycache__" / "app.pyc"))
+
+
+def test_rollback_never_shares_inodes_with_the_snapshot(tree):
+    root, snaps = tree
+    snaps.take(1)
+    _write(str(root / "app.py"), "print('broken')\n")
+    snaps.rollback(1)
+
+    # editing the restored file in place must not change the snapshot
+    with open(str(root / "app.py"), "a", encoding="utf-8") as f:
+        f.write("# edit\n")
+    snaps.rollback(1)
+    assert _read(str(root / "app.py")) == "print('v1')\n"
+
+
+def test_rollback_replaces_a_directory_with_the_snapshotted_file(tree):
+    root, snaps = tree
+    snaps.take(1)
+    os.unlink(str(root / "README.md"))
+    _write(str(root / "README.md" / "inner.txt"), "x\n")
+
+    snaps.rollback(1)
+    assert _read(str(root / "README.md")) == "readme\n"
+
+
+def test_diff_against_next_snapshot_and_current_tree(tree):
+    root, snaps = tree
+    snaps.take(1)
+    _write(str(root / "app.py"), "print('v2!')\n")
+    _write(str(root / "added.txt"), "new\n")
+    snaps.take(2)
+    os.unlink(str(root / "pkg" / "util.py"))
+
+    d1 = snaps.diff(1)
+    assert d1["added"] == ["added.txt"]
+    assert d1["removed"] == []
+    assert d1["modified"] == ["app.py"]
+    assert "-print('v1')" in d1["patch"] and "+print('v2!')" in d1["patch"]
+
+    d2 = snaps.diff(2)
+    assert d2["removed"] == [os.path.join("pkg", "util.py")]
+    assert d2["added"] == [] and d2["modified"] == []
+
+
+def test_prune_keeps_newest_and_unknown_label_raises(tmp_path):
+    root = tmp_path / "work"
+    _write(str(root / "a.txt"), "a\n")
+    snaps = WorkspaceSnapshots(str(root), store=str(tmp_path / "store"), keep=2)
+    for label in range(1, 4):
+        snaps.take(label)
+    assert [s["label"] for s in snaps.labels()] == ["2", "3"]
+    with pytest.raises(KeyError):
+        snaps.rollback(1)
+
+
+def test_vcs_and_dependency_dirs_are_not_snapshotted(tree):
+    root, snaps = tree
+    _write(str(root / ".git" / "HEAD"), "ref\n")
+    _write(str(root / "node_modules" / "x" / "index.js"), "x\n")
+    _write(str(root / ".venv" / "bin" / "python"), "py\n")
+    assert snaps.take(1)["files"] == 3
+
+
+def test_pruned_objects_are_deleted(tmp_path):
+    root = tmp_path / "work"
+    store = tmp_path / "store"
+    snaps = WorkspaceSnapshots(str(root), store=str(store), keep=1)
+    _write(str(root / "a.txt"), "one\n")
+    snaps.take(1)
+    _write(str(root / "a.txt"), "two!\n")
+    snaps.take(2)
+    objects = [f for _, _, files in os.walk(str(store / "objects")) for f in files]
+    assert len(objects) == 1
+
+
+def test_rollback_leaves_files_the_plan_never_touched(tree):
+    root, snaps = tree
+    _write(str(root / "notes.txt"), "mine\n")
+    snaps.take(1)
+    _write(str(root / "generated.py"), "made by a command\n")
+    _write(str(root / "app.py"), "print('broken')\n")
+    snaps.take("end")
+
+    # after the run the user keeps working
+    _write(str(root / "notes.txt"), "mine, edited later\n")
+    _write(str(root / "scratch.txt"), "unrelated\n")
+
+    counts = snaps.rollback(1)
+    assert counts == {"restored": 1, "deleted": 1}
+    assert not os.path.exists(str(root / "generated.py"))
+    assert _read(str(root / "app.py")) == "print('v1')\n"
+    assert _read(str(root / "notes.txt")) == "mine, edited later\n"
+    assert _read(str(root / "scratch.txt")) == "unrelated\n"
+
+
+def test_home_and_filesystem_root_are_refused(tmp_path, monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    snaps = WorkspaceSnapshots(str(tmp_path), store=str(tmp_path / ".e_zero" / "store"))
+    assert not snaps.safe
+    with pytest.raises(ValueError):
+        snaps.take(1)
+    with pytest.raises(ValueError):
+        snaps.rollback(1)
+    assert not WorkspaceSnapshots("/", store=str(tmp_path / "s")).safe